@@ -0,0 +1,206 @@
+"""
+Benchmarks of the data, mask and spectral hot paths.
+
+Runs on synthetic IML images (random big-endian uint16 files of the van
+Hateren size) written to a temporary directory, so no real data is
+needed.  Each case is timed over a few repeats, and its peak traced
+memory recorded; the results are written as JSON, and can be compared
+against an earlier run to catch regressions:
+
+    python -m _scripts.benchmark --output new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2: no peak memory
+    tracemalloc = None
+
+IML_WIDTH = 1536
+IML_HEIGHT = 1024
+
+
+def make_synthetic_images(img_dir, nimages, width=IML_WIDTH,
+                          height=IML_HEIGHT, seed=0):
+    """Writes nimages random .iml files, returning their paths."""
+    rng = np.random.RandomState(seed)
+    paths = []
+    for ii in range(nimages):
+        path = os.path.join(img_dir, 'synthetic%05d.iml' % ii)
+        img = rng.randint(0, 2 ** 12, size=(height, width)).astype('>u2')
+        img.tofile(path)
+        paths.append(path)
+    return paths
+
+
+def measure(fn, repeat=3):
+    """
+    Runs fn() repeat times, returning the wall times (seconds) and the
+    peak traced memory (bytes; None where tracemalloc is missing).
+    """
+    times = []
+    peak = None
+    for _ in range(repeat):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+        if tracemalloc is not None:
+            peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return times, peak
+
+
+def iter_cases(img_dir, image_files, quick=False):
+    """
+    Yields the (name, params, fn) of every benchmark case; the setup
+    of a case happens before it is yielded, so it is not timed.
+    """
+    from de.datasets import ImageDataset, get_patch, read_iml
+
+    yield ('read_iml', {},
+           lambda: np.asarray(read_iml(image_files[0], IML_WIDTH,
+                                       IML_HEIGHT)))
+
+    img = np.asarray(read_iml(image_files[0], IML_WIDTH, IML_HEIGHT))
+    yield ('get_patch', {'patch_size': [32, 32], 'calls': 1000},
+           lambda: [get_patch(img, (32, 32)) for _ in range(1000)])
+
+    for n_jobs, patches_per_image in [(1, None), (1, 16), (4, 16)]:
+        params = dict(ntrain=len(image_files) - 2, ntest=1, nvalid=1,
+                      n_jobs=n_jobs, patches_per_image=patches_per_image)
+        yield ('ImageDataset', params,
+               lambda params=params: ImageDataset(
+                   'train', IML_WIDTH, IML_HEIGHT, img_dir=img_dir,
+                   seed=0, **params))
+
+    from pylearn2.corruption import BinomialCorruptor
+    from de.sparserf_autoencoder import SparseRFAutoencoder
+
+    for size in [32] if quick else [32, 64]:
+        for sigma in [1., 3.]:
+            for numCons in [5, 10, 25]:
+                params = dict(imageSize=[size, size],
+                              sigma=[[sigma, 0.], [0., sigma]],
+                              numCons=numCons, nhid=size * size)
+                yield ('SparseRFAutoencoder.mask', params,
+                       lambda params=params: SparseRFAutoencoder(
+                           nvis=np.prod(params['imageSize']), irange=0.025,
+                           corruptor=BinomialCorruptor(0.01), act_enc=None,
+                           act_dec=None, seed=0, cache_dir=False,
+                           **params).mask)
+
+    from de.fft_analyze import fft2AverageOnImageSet
+    import radialProfile
+    from radial_data import radial_data
+
+    rng = np.random.RandomState(0)
+    for npatches in [1000] if quick else [1000, 10000]:
+        patches = rng.rand(npatches, 32, 32)
+        yield ('fft2AverageOnImageSet', {'n': npatches},
+               lambda patches=patches: fft2AverageOnImageSet(patches))
+
+        spectra = np.abs(np.fft.fft2(patches))
+        yield ('azimuthalAverage', {'n': npatches},
+               lambda spectra=spectra: radialProfile.azimuthalAverage(
+                   spectra))
+
+    spectrum = np.abs(np.fft.fft2(img))
+    yield ('azimuthalAverage', {'shape': list(spectrum.shape)},
+           lambda: radialProfile.azimuthalAverage(spectrum))
+    yield ('radial_data', {'shape': list(spectrum.shape)},
+           lambda: radial_data(spectrum))
+
+
+def run_benchmarks(nimages=12, repeat=3, quick=False):
+    """Returns the results of every case, as a JSON-serializable dict."""
+    img_dir = tempfile.mkdtemp(prefix='benchmark-iml-')
+    try:
+        image_files = make_synthetic_images(img_dir, nimages)
+        results = []
+        for name, params, fn in iter_cases(img_dir, image_files, quick):
+            times, peak = measure(fn, repeat=repeat)
+            results.append(dict(name=name, params=params, times=times,
+                                best=min(times), peak_bytes=peak))
+            print("%-28s %-72s %8.4fs %s" % (
+                name, json.dumps(params, sort_keys=True), min(times),
+                '' if peak is None else '%.1fMB' % (peak / 2. ** 20)))
+    finally:
+        shutil.rmtree(img_dir)
+
+    return dict(
+        created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        machine=platform.platform(),
+        nimages=nimages,
+        repeat=repeat,
+        results=results, )
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    Prints the change of every case's best time and peak memory from a
+    baseline run; returns the cases slower or larger by over tolerance.
+    """
+    def case_key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+
+    old = dict((case_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        key = case_key(result)
+        if key not in old:
+            continue
+        ratios = [('time', result['best'] / old[key]['best'])]
+        if result['peak_bytes'] and old[key]['peak_bytes']:
+            ratios.append(('memory', float(result['peak_bytes']) /
+                           old[key]['peak_bytes']))
+        for measure_name, ratio in ratios:
+            flag = ''
+            if ratio > 1. + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((key, measure_name, ratio))
+            print("%-28s %-72s %-6s x%.2f%s" % (key + (measure_name, ratio,
+                                                      flag)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', default=None,
+                        help="results file (default: benchmark-<time>.json)")
+    parser.add_argument('--compare', default=None,
+                        help="an earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--nimages', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help="skip the largest cases")
+    args = parser.parse_args()
+
+    current = run_benchmarks(nimages=args.nimages, repeat=args.repeat,
+                             quick=args.quick)
+    output = args.output or 'benchmark-%s.json' % time.strftime(
+        '%Y%m%d-%H%M%S')
+    with open(output, 'w') as fp:
+        json.dump(current, fp, indent=2, sort_keys=True)
+    print("Wrote %s" % output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(baseline, current, tolerance=args.tolerance):
+            sys.exit(1)
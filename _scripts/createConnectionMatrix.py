@@ -1,5 +1,9 @@
+# Run from the repository root: python -m _scripts.createConnectionMatrix
 import numpy as np
-import matplotlib.pyplot as plt
+
+from de.connectivity import connection_mask, sample_connections
+from de.connectivity_stats import connectivity_stats
+from de.render import plot_connections
 
 # =========================================================================== #
 #  Function Name: createConnectionMatrix                                      #
@@ -28,141 +32,74 @@ import matplotlib.pyplot as plt
 
 
 def createConnectionMatrix(imageSize, hiddenUnitLocs, numConnections, sigma):
-
-    # Define some useful local variables for sake of clarity
-    imgHeight = imageSize[0]
-    imgLength = imageSize[1]
-    numPixels = imgHeight * imgLength
-    numHiddenUnits = len(hiddenUnitLocs)
-
-    # Initialize the Connection Matrix to all zeroes
-    connectionMatrix = np.zeros(shape=(numHiddenUnits, numPixels))
-    currHiddenUnit = 0  # index to keep track of which hidden unit
-
-    # Create a variance parameter by squaring each element in sigma,
-    # used in Gaussian
-    variance = [[elem * elem for elem in inner] for inner in sigma]
-
-    # Loop through the Hidden Units to Create Samples
-    for k in hiddenUnitLocs:
-
-        i = 0
-        while i < numConnections:
-
-            # Get random Gaussian sample which returns an array of tuples
-            [[x, y]] = np.random.multivariate_normal(k, variance, 1)
-
-            # Round the sample to nearest integer
-            x = round(x, 0)
-            y = round(y, 0)
-
-            # Check to see if it's out of bounds.
-            if (x >= imgLength) or (y >= imgHeight) or (x < 0) or (y < 0):
-                continue
-
-            # Calculate which pixel number it is to add to the map.
-            pixelLoc = (y) * imgLength + (x)
-
-            if (connectionMatrix[currHiddenUnit][pixelLoc] == 1):
-                continue
-
-            connectionMatrix[currHiddenUnit][pixelLoc] = 1
-            i += 1
-
-        currHiddenUnit += 1
-
-    return connectionMatrix
-
-
-# Basic function to check equality of floating point numbers
-def approx_equal(a, b, epsilon=0.000000001):
-    return abs(a - b) < epsilon
+    connections = sample_connections(
+        imageSize, hiddenUnitLocs, numConnections, sigma)
+    numPixels = imageSize[0] * imageSize[1]
+    return connection_mask(connections, numPixels).T
 
 
 # Basic tester that makes sure that the connectionMatrix has the
 # correct amount of connections for now. Rest of checking was done manually.
 def testConnectionMatrix(matrix, numConnection, numHiddenUnit, imageSize):
-    connectionCounter = 0
-    for (r, c), value in np.ndenumerate(matrix):
-        if approx_equal(value, 1.0):
-            print "Hidden unit # %2d: Connection at %s" % (
-                  r, np.unravel_index(c, imageSize),)
-
-            connectionCounter += 1
-    try:
-        assert True
-        assert numConnection * numHiddenUnit == connectionCounter
-    except AssertionError:
-        print "Expected num of connections: %d.\n Received: %d." % (
-              numConnection * numHiddenUnit, connectionCounter)
+    units, pixels = np.nonzero(np.isclose(matrix, 1.0))
+    for r, row, col in zip(units, *np.unravel_index(pixels, imageSize)):
+        print("Hidden unit # %2d: Connection at (%d, %d)" % (r, row, col))
+
+    connectionCounter = len(units)
+    if numConnection * numHiddenUnit != connectionCounter:
+        print("Expected num of connections: %d.\n Received: %d." % (
+              numConnection * numHiddenUnit, connectionCounter))
         exit(1)
 
 
 # Graph a matrix on the Cartesian Plane, with a marking at any location
-# where there's a connection or a hidden unit
-def graphConnectionMatrix(matrix, imageSize, hiddenUnitLocs):
-    plt.figure()  # create new window for graph
-
-    # Plot all of the hidden unit locations
-    for x, y in hiddenUnitLocs:
-        plt.plot(x, y, 'ro')
-
-    # Plot all the connection points
-    for (r, c), value in np.ndenumerate(matrix):
-        if approx_equal(value, 1.0):
-            [x, y] = np.unravel_index(c, imageSize)
-            plt.plot(x, y, 'bx')
-
-    plt.axis([-1, imageSize[0], -1, imageSize[1]])
-    plt.show()
+# where there's a connection or a hidden unit (see de.render).
+def graphConnectionMatrix(matrix, imageSize, hiddenUnitLocs, out_path=None):
+    units, pixels = np.nonzero(np.isclose(matrix, 1.0))
+    # The pixels of each unit; units may have different numbers of them
+    counts = np.bincount(units, minlength=matrix.shape[0])
+    connections = np.split(pixels, np.cumsum(counts)[:-1])
+    plot_connections(connections, hiddenUnitLocs, imageSize,
+                     out_path=out_path)
 
 
 def doTest(testName, nConns, imageSize, hiddenUnitLocs, sigma):
 
-    print "---------------------------\n"
-    print "\n%s:\n" % testName
+    print("---------------------------\n")
+    print("\n%s:\n" % testName)
 
     mat = createConnectionMatrix(imageSize, hiddenUnitLocs, nConns, sigma)
 
-    print "\nTesting and Graphing Resulting Matrix:\n"
+    print("\nTesting and Graphing Resulting Matrix:\n")
     testConnectionMatrix(mat, nConns, len(hiddenUnitLocs), imageSize)
     graphConnectionMatrix(mat, imageSize, hiddenUnitLocs)
 
 
-def doRatioTest(testName, nConns, imageSize, hiddenUnitLocs, sigma):
-
-    print "---------------------------\n"
-    print "\n%s:\n" % testName
-
-    ratioOfConnections = 0.0
-    numTrials = 100
-    for i in range(0, numTrials):
+# Samples many connection matrices at once, in parallel, and reports their
+# statistics (see de.connectivity_stats).
+def doRatioTest(testName, nConns, imageSize, hiddenUnitLocs, sigma,
+                numTrials=100):
 
-        mat = createConnectionMatrix(imageSize, hiddenUnitLocs, nConns, sigma)
+    print("---------------------------\n")
+    print("\n%s:\n" % testName)
 
-        ratioOfConnections += getPropOfHUwithSample(
-            mat,
-            hiddenUnitLocs,
-            imageSize)
-
-    ratioOfConnections = ratioOfConnections / numTrials
-    print "Ratio is: " + str(ratioOfConnections)
-
-
-# Given a matrix and the hidden unit locations, find the proportion of hidden
-# units that also have a sample at their locaiton.
-def getPropOfHUwithSample(matrix, hiddenUnitLocs, imageSize):
-    numHULocs = len(hiddenUnitLocs)
-    numSampleAtHULoc = 0  # counter
-    for (r, c), value in np.ndenumerate(matrix):
-        if approx_equal(value, 1.0):
-            [x, y] = np.unravel_index(c, imageSize)  # current sample
-            b = hiddenUnitLocs[r]  # get the current hidden unit
-
-            if (x == b[1] and y == b[0]):
+    stats = connectivity_stats(imageSize, hiddenUnitLocs, nConns, sigma,
+                               ntrials=numTrials)
+    expected = nConns * len(hiddenUnitLocs)
+    bad = np.count_nonzero(stats['connections'] != expected)
+    if bad:
+        print("%d of %d trials do not have %d connections" % (
+            bad, numTrials, expected))
+        exit(1)
 
-                numSampleAtHULoc += 1
-    return numSampleAtHULoc / float(numHULocs)  # get the proportion
+    distances = stats['distance_edges'][:-1]
+    hist = stats['distance_hist']
+    print("Ratio is: " + str(stats['self_ratio'].mean()))
+    print("Mean connection distance: %.3f" % (
+        (distances + 0.5).dot(hist) / float(hist.sum())))
+    print("Pixels ever connected: %d of %d" % (
+        np.count_nonzero(stats['pixel_coverage']),
+        len(stats['pixel_coverage'])))
 
 
 if __name__ == "__main__":
@@ -197,14 +134,9 @@ if __name__ == "__main__":
 
     # 4. small image, three units, 12 connections, 12 pixels.
     # Each pixel maps to each hidden unit
-
-    # This test is too slow for automatic ratio test.
-    # Comment out condition manually if you specifically want to try
-    # the ratio test on this test case.
-    if (myTest != doRatioTest):
-        myTest(
-            testName="3 hidden units, connecting to all pixels",
-            nConns=12,
-            imageSize=(4, 3),
-            hiddenUnitLocs=np.array([[0, 0], [2, 2], [3, 2]]),
-            sigma=[[1, 0], [0, 1]])
+    myTest(
+        testName="3 hidden units, connecting to all pixels",
+        nConns=12,
+        imageSize=(4, 3),
+        hiddenUnitLocs=np.array([[0, 0], [2, 2], [3, 2]]),
+        sigma=[[1, 0], [0, 1]])
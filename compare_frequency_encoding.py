@@ -1,50 +1,50 @@
 
+# Set DE_TRACE=<path> to record the time spent in each stage (see de.trace).
 if __name__ == "__main__":
-    import os
     import sys
-    import tempfile
+
+    from de import trace
 
     plotting_param = sys.argv[1] if len(sys.argv) > 1 else True
+    # Training and comparison processes (default: one per core)
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else None
 
-    hemi_params = {
-        'left':  {'sigma': [[5, 0], [0, 5]]},
-        'right': {'sigma': [[3, 0], [0, 3]]}, }
+    # (left, right) hemisphere settings; every combination is trained.
+    sweep_grid = {
+        'sigma': [([[5, 0], [0, 5]], [[3, 0], [0, 3]])],
+        'numCons': [10],
+        'nhid': [1024],
+        'hpl': [1],
+        'corruption_level': [0.01], }
 
     # Create the dataset
     from de.datasets import VanHateren
-    VanHateren.create_datasets()
-
-    for hemi in hemi_params.keys():
-        weights_file = '%s.pkl' % hemi
-        if os.path.exists(weights_file):
-            continue
-
-        params = (  # must be in order...
-            10,  # number of connections
-            hemi_params[hemi]['sigma'],
-            weights_file)  # weights file
-
-        # Create the yaml file.
-        _, config_fn = tempfile.mkstemp()
-        with open("sparserf_template.yaml") as fp:
-            # create yaml from templtes + params
-            yaml_template = "".join(fp.readlines())
-            config_yaml = yaml_template % params
-        with open(config_fn, 'w') as config_fp:
-            config_fp.write(config_yaml)
-
-        # Train the network
-        from pylearn2.scripts.train import train
-        train(config=config_fn)
-
-        # Visualize the weights
-        # from pylearn2.scripts.show_weights import show_weights
-        # show_weights(model_path=weights_file, border=True)
-
-        # Visualize the reconstruction
-        # from de.compare_reconstruct import compare_reconstruction
-        # compare_reconstruction(model_path=weights_file)
-
-    # Analyze frequency information
-    from de.fft_analyze import hemisphericalDifferences
-    hemisphericalDifferences('left.pkl', 'right.pkl', plotting=plotting_param)
+    with trace.span('driver.create_datasets'):
+        VanHateren.create_datasets()
+
+    # Train the networks, in parallel; finished models are reused.
+    from de.sweep import comparison_key, param_grid, run_sweep
+    configs = param_grid(**sweep_grid)
+    with trace.span('driver.sweep'):
+        store = run_sweep(configs, n_jobs=n_jobs)
+
+    # Visualize the weights
+    # from de.render import save_mosaics
+    # save_mosaics(weights_file, 'weights')
+
+    # Visualize the reconstruction
+    # from de.compare_reconstruct import compare_reconstruction
+    # compare_reconstruction(model_path=weights_file)
+
+    # Analyze frequency information, as computed by the sweep
+    from de.fft_analyze import plotHemisphericalSpectra
+    for comparison in store.comparisons(map(comparison_key, configs)):
+        print("Configuration: %s" % comparison['config'])
+        spectra = store.load_spectra(comparison['key'])
+        print("Total difference (RH better: > 0): %s" % (
+            spectra['total_difference'], ))
+        if plotting_param:
+            with trace.span('driver.analysis', key=comparison['key']):
+                plotHemisphericalSpectra(spectra, comparison['left_path'],
+                                         comparison['right_path'],
+                                         plotting=plotting_param)
@@ -0,0 +1,210 @@
+"""
+Compact, memory-mappable model archives.
+
+An archive is a directory holding one .npy file per parameter array
+(encoder weights, connections, biases, decoder weights) and a
+meta.json of the model class, sizes, activations and hyperparameters.
+The connection mask is stored sparsely, as the [nhid x numCons] pixel
+indices in the smallest unsigned integer type that fits.
+
+ModelArchive reads meta.json only, and memory-maps each array the
+first time it is accessed, checking it against the sha1 recorded in
+meta.json; it can be passed straight to
+NumpyAutoencoder (de.inference).  to_model and save_archive convert
+to and from the pylearn2 model objects that are pickled by serial.save.
+"""
+import hashlib
+import importlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .inference import model_arrays
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+ARRAY_NAMES = ('weights', 'connections', 'hidbias', 'visbias', 'w_prime')
+HYPERPARAMETERS = ('numCons', 'sigma', 'imageSize', 'hpl', 'seed', 'irange')
+
+
+def _jsonable(value):
+    return value.tolist() if hasattr(value, 'tolist') else value
+
+
+def save_archive(model, path):
+    """
+    Saves a trained (SparseRF)Autoencoder as an archive directory; an
+    existing archive at path is replaced.
+    """
+    arrays = model_arrays(model)
+    if 'connections' in arrays:
+        nvis = int(arrays['nvis'])
+        arrays['connections'] = arrays['connections'].astype(
+            np.min_scalar_type(nvis - 1))
+
+    cls = model.__class__
+    corruptor = getattr(model, 'corruptor', None)
+    meta = dict(
+        format=FORMAT_VERSION,
+        model={
+            'class': '%s.%s' % (cls.__module__, cls.__name__),
+            'nvis': int(arrays['nvis']),
+            'nhid': int(arrays['nhid']),
+            'act_enc': str(arrays['act_enc']),
+            'act_dec': str(arrays['act_dec']),
+            'tied_weights': bool(getattr(model, 'tied_weights', False)),
+            'corruption_level': _jsonable(
+                getattr(corruptor, 'corruption_level', None)), },
+        hyperparameters=dict(
+            (name, _jsonable(getattr(model, name)))
+            for name in HYPERPARAMETERS
+            if getattr(model, name, None) is not None),
+        arrays={})
+
+    # Written next to path, then moved into place
+    tmp_path = path.rstrip(os.sep) + '.partial'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in ARRAY_NAMES:
+        if name not in arrays:
+            continue
+        array = np.ascontiguousarray(arrays[name])
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+        meta['arrays'][name] = dict(
+            dtype=array.dtype.str, shape=list(array.shape),
+            sha1=hashlib.sha1(array.tobytes()).hexdigest())
+    with open(os.path.join(tmp_path, META_FILE), 'w') as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class ModelArchive(object):
+    """
+    A saved archive.  archive[name] returns a parameter array
+    (memory-mapped, unless mmap_mode is None) or a model field of
+    meta.json (nvis, nhid, act_enc, act_dec, and the hyperparameters).
+
+    Arrays whose dtype, shape or sha1 differ from meta.json raise a
+    ValueError when first accessed, unless verify is False.
+    """
+
+    def __init__(self, path, mmap_mode='r', verify=True):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.verify = verify
+        with open(os.path.join(path, META_FILE)) as fp:
+            self.meta = json.load(fp)
+        if self.meta['format'] > FORMAT_VERSION:
+            raise ValueError("%s has format %d; only %d is supported" % (
+                path, self.meta['format'], FORMAT_VERSION))
+        self._arrays = {}
+
+    def _fields(self):
+        return dict(self.meta['hyperparameters'], **self.meta['model'])
+
+    def keys(self):
+        fields = self._fields()
+        return sorted(list(self.meta['arrays']) +
+                      [name for name in fields if fields[name] is not None])
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __getitem__(self, name):
+        if name in self.meta['arrays']:
+            if name not in self._arrays:
+                array = np.load(os.path.join(self.path, name + '.npy'),
+                                mmap_mode=self.mmap_mode)
+                if self.verify:
+                    self._verify(name, array)
+                self._arrays[name] = array
+            return self._arrays[name]
+        value = self._fields().get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def _verify(self, name, array):
+        expected = self.meta['arrays'][name]
+        if (array.dtype.str != expected['dtype'] or
+                list(array.shape) != expected['shape'] or
+                hashlib.sha1(np.ascontiguousarray(array).tobytes())
+                .hexdigest() != expected['sha1']):
+            raise ValueError("%s.npy in %s does not match its checksum; "
+                             "the archive is corrupted" % (name, self.path))
+
+
+def to_model(archive):
+    """
+    Rebuilds the pylearn2 model saved in an archive (or at its path),
+    e.g. to pickle it with serial.save.  A DenoisingAutoencoder saved
+    without a corruptor comes back as a plain Autoencoder, and its
+    subclasses with a corruption_level of 0.
+    """
+    if not isinstance(archive, ModelArchive):
+        archive = ModelArchive(archive)
+    model_meta = archive.meta['model']
+    module_name, class_name = model_meta['class'].rsplit('.', 1)
+    cls = getattr(importlib.import_module(module_name), class_name)
+
+    kwargs = dict(archive.meta['hyperparameters'],
+                  nvis=model_meta['nvis'],
+                  nhid=model_meta['nhid'],
+                  tied_weights=model_meta['tied_weights'])
+    for act in ['act_enc', 'act_dec']:
+        kwargs[act] = None if model_meta[act] == 'linear' else model_meta[act]
+    if 'connections' in archive.meta['arrays']:
+        # The saved connections, rather than newly sampled ones
+        kwargs['connections'] = np.array(archive['connections'],
+                                         dtype='int32')
+
+    from pylearn2.corruption import BinomialCorruptor
+    from pylearn2.models.autoencoder import Autoencoder, DenoisingAutoencoder
+    corruption_level = model_meta['corruption_level']
+    if corruption_level is None and cls is DenoisingAutoencoder:
+        cls = Autoencoder
+    elif corruption_level is None and issubclass(cls, DenoisingAutoencoder):
+        # Subclasses (e.g. SparseRFAutoencoder) need a corruptor
+        kwargs['corruptor'] = BinomialCorruptor(corruption_level=0.)
+    elif corruption_level is not None:
+        kwargs['corruptor'] = BinomialCorruptor(
+            corruption_level=corruption_level)
+    model = cls(**kwargs)
+
+    names = ['weights', 'hidbias', 'visbias']
+    if not model_meta['tied_weights']:
+        names.append('w_prime')
+    for name in names:
+        param = getattr(model, name)
+        param.set_value(np.array(archive[name],
+                                 dtype=param.get_value().dtype))
+    return model
+
+
+def convert(src, dst):
+    """
+    Converts a pickled model to an archive, or an archive (directory)
+    to a pickled model.
+    """
+    from pylearn2.utils import serial
+    if is_archive(src):
+        serial.save(dst, to_model(src))
+    else:
+        save_archive(serial.load(src), dst)
+
+
+if __name__ == '__main__':
+    # python -m de.archive model.pkl model.archive  (or the reverse)
+    import sys
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,196 @@
+"""
+Confidence intervals for hemispheric spectral differences.
+
+hemisphericalDifferences compares one left and one right model, each
+with a single random connection mask, over one pass of the training
+set.  Here N seeds per hemisphere are trained (or reused from a sweep
+store) and evaluated in parallel workers, and the RH - LH difference
+is bootstrapped over both images and seeds.
+
+Images are resampled with Poisson(1) weights: each worker streams the
+training set in fixed chunks, computes per-image radial PSDs, and only
+keeps their weighted sums per bootstrap replicate.  The weights of a
+chunk are drawn from a seed derived from the chunk index, so every
+worker sees the same resampling of the images.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+
+from .reconstruction import DEFAULT_BATCH_SIZE, load_reconstruction
+from .spectra import DEFAULT_CHUNK_SIZE, magnitude_spectra
+from .sweep import (TEMPLATE_PATH, SweepStore, hemisphere_params,
+                    model_key, train_models)
+
+DEFAULT_N_BOOT = 1000
+
+
+def _profile_sums(job):
+    """
+    Streams the training set through a model (or none, for the original
+    patches), returning the bootstrap-weighted sums of the per-image
+    radial PSDs, the sums of the weights, and the unweighted sum/count.
+    """
+    (model_path, train_path, patch_size, n_boot, boot_seed,
+     chunk_size, batch_size, cache_dir) = job
+
+    import radialProfile
+    from .design import load_dataset
+
+    train_set = load_dataset(train_path)
+    design = train_set.X
+    if model_path is not None:
+        design = load_reconstruction(model_path, train_path, train_set.X,
+                                     cache_dir=cache_dir,
+                                     batch_size=batch_size)
+
+    sums = weights_total = total = None
+    count = 0
+    nrows = design.shape[0]
+    for chunk_idx, start in enumerate(range(0, nrows, chunk_size)):
+        X = np.asarray(design[start:start + chunk_size])
+        images = train_set.denormalize_image(X).reshape((-1,) + patch_size)
+        profiles = radialProfile.azimuthalAverage(magnitude_spectra(images))
+
+        # Same chunk, same weights, in every worker
+        rng = np.random.RandomState(boot_seed + chunk_idx)
+        weights = rng.poisson(1., size=(n_boot, profiles.shape[0]))
+
+        if sums is None:
+            sums = np.zeros((n_boot, profiles.shape[1]))
+            weights_total = np.zeros(n_boot)
+            total = np.zeros(profiles.shape[1])
+        sums += weights.dot(profiles)
+        weights_total += weights.sum(axis=1)
+        total += profiles.sum(axis=0)
+        count += profiles.shape[0]
+
+    return sums, weights_total, total, count
+
+
+def bootstrap_differences(left_model_paths, right_model_paths,
+                          n_boot=DEFAULT_N_BOOT, ci=0.95, boot_seed=0,
+                          n_jobs=None, train_path=None, patch_size=(32, 32),
+                          chunk_size=DEFAULT_CHUNK_SIZE,
+                          batch_size=DEFAULT_BATCH_SIZE, cache_dir=None,
+                          pool=None):
+    """
+    Bootstraps the hemispherical difference, |LH - orig| - |RH - orig|
+    of the radial PSDs (RH better: > 0), over the training images and
+    over the given seeds (models) of each hemisphere.
+
+    Each replicate resamples the images, then the left and right seeds,
+    and averages the difference over the resampled seeds.
+
+    Parameters:
+    ----------
+    left_model_paths, right_model_paths: the models of each hemisphere,
+        one per seed.
+    n_boot: the number of bootstrap replicates.
+    ci: the coverage of the percentile confidence interval.
+    n_jobs: the number of worker processes, when no pool is given
+        (default: one per core).
+    cache_dir: where to cache the reconstructions (see
+        load_reconstruction); by default they are not kept.
+
+    Returns a dict of per-frequency arrays: frequency (the radial bin
+    centers), mean (the estimate over all images and seeds), std, and
+    lower / upper (the confidence interval).
+    """
+    if train_path is None:
+        from .datasets import VanHateren
+        train_path = os.path.join(VanHateren.DATA_DIR, 'train.pkl')
+    left_model_paths = list(left_model_paths)
+    right_model_paths = list(right_model_paths)
+    patch_size = tuple(patch_size)
+
+    model_paths = [None] + left_model_paths + right_model_paths
+    jobs = [(path, train_path, patch_size, n_boot, boot_seed,
+             chunk_size, batch_size, cache_dir) for path in model_paths]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(n_jobs or multiprocessing.cpu_count(),
+                                    maxtasksperchild=1)
+    try:
+        print("Computing PSDs for %d models..." % (len(model_paths) - 1))
+        results = pool.map(_profile_sums, jobs)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    # [n_boot x nbins] replicates, and the full-sample [nbins] means
+    replicates = [sums / weights_total[:, np.newaxis]
+                  for sums, weights_total, _, _ in results]
+    full = [total / count for _, _, total, count in results]
+
+    nleft = len(left_model_paths)
+    orig, left, right = replicates[0], replicates[1:nleft + 1], \
+        replicates[nleft + 1:]
+    left_errors = np.array([np.abs(rep - orig) for rep in left])
+    right_errors = np.array([np.abs(rep - orig) for rep in right])
+
+    # Resample the seeds of each hemisphere, independently per replicate
+    rng = np.random.RandomState(boot_seed)
+    boot_idx = np.arange(n_boot)[:, np.newaxis]
+    left_seeds = rng.randint(len(left), size=(n_boot, len(left)))
+    right_seeds = rng.randint(len(right), size=(n_boot, len(right)))
+    differences = (left_errors[left_seeds, boot_idx].mean(axis=1) -
+                   right_errors[right_seeds, boot_idx].mean(axis=1))
+
+    orig_full = full[0]
+    mean = (np.mean([np.abs(f - orig_full) for f in full[1:nleft + 1]],
+                    axis=0) -
+            np.mean([np.abs(f - orig_full) for f in full[nleft + 1:]],
+                    axis=0))
+
+    import radialProfile
+    alpha = (1. - ci) / 2.
+    lower, upper = np.percentile(differences, [100 * alpha,
+                                               100 * (1. - alpha)], axis=0)
+    return dict(
+        frequency=radialProfile.get_bin_plan(patch_size).radii,
+        mean=mean,
+        std=differences.std(axis=0, ddof=1),
+        lower=lower,
+        upper=upper, )
+
+
+def bootstrap_hemispheres(sigma, n_seeds=5, store_dir='sweep', n_jobs=None,
+                          template_path=TEMPLATE_PATH, **kwargs):
+    """
+    Trains n_seeds left and right models (seeds 0 .. n_seeds - 1) for a
+    (left, right) pair of sigmas, reusing any already in the sweep store,
+    then runs bootstrap_differences on them, from their NumPy archives
+    where they have one (see SweepStore.analysis_path).
+
+    Model parameters (numCons, nhid, ...) and bootstrap_differences
+    options are both passed as keyword arguments.
+    """
+    boot_options = ('n_boot', 'ci', 'boot_seed', 'train_path', 'patch_size',
+                    'chunk_size', 'batch_size', 'cache_dir')
+    boot_kwargs = dict((k, kwargs.pop(k)) for k in boot_options
+                       if k in kwargs)
+
+    store = SweepStore(store_dir)
+    models = {}
+    hemi_keys = ([], [])
+    for seed in range(n_seeds):
+        config = dict(kwargs, sigma=sigma, seed=seed)
+        for keys, params in zip(hemi_keys, hemisphere_params(config)):
+            keys.append(model_key(params))
+            models[keys[-1]] = params
+
+    pool = multiprocessing.Pool(n_jobs or multiprocessing.cpu_count(),
+                                maxtasksperchild=1)
+    try:
+        train_models(store, models, pool, template_path)
+        return bootstrap_differences(
+            [store.analysis_path(key) for key in hemi_keys[0]],
+            [store.analysis_path(key) for key in hemi_keys[1]],
+            pool=pool, **boot_kwargs)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,221 @@
+"""
+Helpers for content-addressed caching of derived artifacts.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+KEY_LENGTH = 12
+ENV_VAR = 'DE_CACHE_DIR'
+
+
+def fingerprint(*parts):
+    """
+    Returns a short hex digest of any JSON-serializable parts
+    (non-serializable values are hashed by their str()).
+    """
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()[:KEY_LENGTH]
+
+
+def resolve_cache_dir(cache_dir=None, default=None):
+    """
+    Maps a cache_dir argument to a directory, or to None for no caching:
+    False disables caching, and None stands for DE_CACHE_DIR if set in
+    the environment, else default.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(ENV_VAR) or default
+    return cache_dir or None
+
+
+def file_stats(paths):
+    """Returns the (path, size, mtime) of each file, for fingerprinting."""
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append((os.path.abspath(path), st.st_size, st.st_mtime))
+    return stats
+
+
+def point_alias(alias, target):
+    """
+    Makes alias refer to target: a relative symlink where possible,
+    otherwise a copy.
+    """
+    if os.path.lexists(alias):
+        os.remove(alias)
+    try:
+        os.symlink(os.path.relpath(target, os.path.dirname(alias)), alias)
+    except (AttributeError, NotImplementedError, OSError):
+        shutil.copyfile(target, alias)
+
+
+def file_digest(path, block_size=2 ** 20):
+    """Returns the sha1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    """
+    A size-bounded, least-recently-used cache of arrays, stored as .npy
+    files in a directory and returned memory-mapped.
+
+    A sqlite index (index.db) records the size and last use of every
+    entry, and the content digests of hashed files, so unchanged files
+    are only read once.
+
+    Parameters:
+    ----------
+    directory: where the entries live; created if missing.
+    max_bytes: entries are evicted, least recently used first, to keep
+        their total size under this.
+    """
+    DEFAULT_MAX_BYTES = 8 * 2 ** 30
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'),
+                                  timeout=60)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, nbytes INTEGER, last_used REAL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "digest TEXT)")
+        self.reconcile()
+
+    def reconcile(self):
+        """
+        Indexes any entry file missing from the index (e.g. one committed
+        by a process that crashed, or raced with a get), so that it can
+        be evicted.
+        """
+        indexed = set(row[0] for row in
+                      self.db.execute("SELECT key FROM entries"))
+        with self.db:
+            for name in os.listdir(self.directory):
+                key, ext = os.path.splitext(name)
+                if ext != '.npy' or '.' in key or key in indexed:
+                    continue
+                st = os.stat(self.path(key))
+                self.db.execute(
+                    "INSERT OR IGNORE INTO entries VALUES (?, ?, ?)",
+                    (key, st.st_size, st.st_mtime))
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.npy' % key)
+
+    def digest(self, path):
+        """
+        Returns file_digest(path), reused while the file is unchanged; a
+        directory's digest combines those of its files.
+        """
+        if os.path.isdir(path):
+            return fingerprint([(name, self.digest(os.path.join(path, name)))
+                                for name in sorted(os.listdir(path))])
+
+        (path, size, mtime), = file_stats([path])
+        row = self.db.execute(
+            "SELECT digest FROM digests WHERE path = ? AND size = ? "
+            "AND mtime = ?", (path, size, mtime)).fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = file_digest(path)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                (path, size, mtime, digest))
+        return digest
+
+    def get(self, key, mmap_mode='r'):
+        """Returns the cached array, memory-mapped, or None on a miss."""
+        if not os.path.exists(self.path(key)):
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+
+        with self.db:
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?",
+                            (time.time(), key))
+        return np.load(self.path(key), mmap_mode=mmap_mode)
+
+    def create(self, key, shape, dtype=float):
+        """
+        Returns a writable, memory-mapped array to fill in and pass to
+        commit; it is not visible to get until then.
+        """
+        tmp_path = self.path('%s.%d.partial' % (key, os.getpid()))
+        return np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=dtype,
+            shape=tuple(int(n) for n in shape))
+
+    def commit(self, key, array):
+        """
+        Stores an array from create() under key, evicts least recently
+        used entries as needed, and returns the entry memory-mapped.
+        """
+        array.flush()
+        tmp_path = array.filename
+        del array
+
+        # Index the entry before it appears: after a crash in between, get
+        # drops the index row of the missing file.
+        nbytes = os.path.getsize(tmp_path)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                            (key, nbytes, time.time()))
+        os.rename(tmp_path, self.path(key))
+        self.evict(keep=key)
+        return self.get(key)
+
+    def put(self, key, array):
+        """Stores a copy of an array under key; see commit."""
+        array = np.asarray(array)
+        out = self.create(key, array.shape, dtype=array.dtype)
+        out[...] = array
+        return self.commit(key, out)
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached array, first storing compute() on a miss."""
+        cached = self.get(key)
+        if cached is None:
+            cached = self.put(key, compute())
+        return cached
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries (except keep) until the
+        cache fits in max_bytes.
+        """
+        rows = self.db.execute(
+            "SELECT key, nbytes FROM entries ORDER BY last_used DESC")
+        total = 0
+        stale = []
+        for key, nbytes in rows.fetchall():
+            total += nbytes
+            if total > self.max_bytes and key != keep:
+                stale.append(key)
+                total -= nbytes
+
+        with self.db:
+            for key in stale:
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
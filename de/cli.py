@@ -0,0 +1,194 @@
+"""
+Headless command line for the analyses:
+
+    python -m de.cli spectrum MODEL [MODEL ...]
+    python -m de.cli hemispheres LEFT RIGHT [LEFT RIGHT ...]
+    python -m de.cli hemispheres --pairs pairs.txt
+    python -m de.cli reconstruct MODEL --idx 4 10 20
+
+Results are written to --out-dir as .npz (and/or .json) files, with
+plots rendered to .png by the non-interactive Agg backend unless
+--no-plots is given.  The training set is loaded once per invocation,
+and matplotlib, pylearn2 and Theano are only imported when needed.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _save_results(results, out_base, formats):
+    """Saves a dict of arrays to out_base.npz and/or out_base.json."""
+    paths = []
+    if 'npz' in formats:
+        np.savez(out_base + '.npz', **results)
+        paths.append(out_base + '.npz')
+    if 'json' in formats:
+        with open(out_base + '.json', 'w') as fp:
+            json.dump(dict((key, np.asarray(value).tolist())
+                           for key, value in results.items()),
+                      fp, sort_keys=True)
+        paths.append(out_base + '.json')
+    for path in paths:
+        print("Saved %s" % path)
+
+
+def _read_pairs(args):
+    models = list(args.models)
+    if args.pairs:
+        with open(args.pairs) as fp:
+            for line in fp:
+                line = line.split('#')[0].split()
+                if line:
+                    models.extend(line)
+    if not models or len(models) % 2:
+        raise SystemExit("hemispheres needs (left, right) pairs of models")
+    return list(zip(models[0::2], models[1::2]))
+
+
+def run_spectrum(args, options):
+    from .fft_analyze import (loadTrainSet, plotSingleImageSpectra,
+                              singleImageSpectra)
+
+    train_path, train_set = loadTrainSet(args.train_path)
+    for model_path in args.models:
+        spectra = singleImageSpectra(model_path, train_path=train_path,
+                                     train_set=train_set, **options)
+        out_base = os.path.join(args.out_dir, _stem(model_path))
+        _save_results(spectra, out_base + '.spectrum', args.formats)
+        if args.plots:
+            for path in plotSingleImageSpectra(spectra, out_base + '_fft'):
+                print("Saved %s" % path)
+
+
+def run_hemispheres(args, options):
+    from .fft_analyze import (hemisphericalSpectra, loadTrainSet,
+                              patchSpectrum, plotHemisphericalSpectra)
+
+    pairs = _read_pairs(args)
+    train_path, train_set = loadTrainSet(args.train_path)
+    orig_spectrum = patchSpectrum(train_set, train_set.X)
+
+    for left_path, right_path in pairs:
+        print("Comparing %s and %s" % (left_path, right_path))
+        spectra = hemisphericalSpectra(
+            left_path, right_path, train_path=train_path,
+            train_set=train_set, orig_spectrum=orig_spectrum, **options)
+        out_base = os.path.join(args.out_dir, '%s_vs_%s' % (
+            _stem(left_path), _stem(right_path)))
+        _save_results(spectra, out_base, args.formats)
+        if args.plots:
+            plotHemisphericalSpectra(spectra, left_path, right_path,
+                                     plotting=out_base + '.png')
+            print("Saved %s" % (out_base + '.png'))
+
+
+def run_reconstruct(args, options):
+    from .compare_reconstruct import plot_reconstructions, reconstruct_patches
+
+    for model_path in args.models:
+        originals, reconstructions = reconstruct_patches(
+            model_path, img_idx=args.idx, train_path=args.train_path,
+            **options)
+        out_base = os.path.join(args.out_dir,
+                                _stem(model_path) + '.reconstruction')
+        _save_results(dict(indices=np.asarray(args.idx), original=originals,
+                           reconstructed=reconstructions),
+                      out_base, args.formats)
+        if args.plots:
+            plot_reconstructions(originals, reconstructions,
+                                 plt_out=out_base + '.png')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m de.cli',
+        description="Spectral and reconstruction analyses of trained "
+                    "models, without a display.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--train-path', default=None,
+                        help="dataset pickle (default: van Hateren train)")
+    common.add_argument('--out-dir', default='.',
+                        help="where results and plots are written")
+    common.add_argument('--format', dest='formats', default='npz',
+                        choices=['npz', 'json', 'npz,json'],
+                        help="numeric results format(s)")
+    common.add_argument('--no-plots', dest='plots', action='store_false',
+                        help="only write numeric results")
+    common.add_argument('--engine', default=None,
+                        choices=['theano', 'numpy'],
+                        help="reconstruction engine (default: numpy for "
+                             ".npz models, else theano)")
+    common.add_argument('--batch-size', type=int, default=None)
+    common.add_argument('--precision', default=None,
+                        choices=['float32', 'float64'],
+                        help="precision of the numpy engine (default: the "
+                             "model's; see de.precision)")
+    common.add_argument('--cache-dir', default=None,
+                        help="reconstruction cache (default: the dataset's)")
+    common.add_argument('--no-cache', action='store_true',
+                        help="do not cache reconstructions")
+    common.add_argument('--trace', default=None,
+                        help="write a timing trace here (see de.trace)")
+
+    subparsers = parser.add_subparsers(dest='command')
+    spectrum = subparsers.add_parser(
+        'spectrum', parents=[common],
+        help="average spectra of the patches and their reconstructions")
+    spectrum.add_argument('models', nargs='+')
+    spectrum.set_defaults(run=run_spectrum)
+
+    hemispheres = subparsers.add_parser(
+        'hemispheres', parents=[common],
+        help="hemispherical differences of (left, right) model pairs")
+    hemispheres.add_argument('models', nargs='*',
+                             help="left right [left right ...]")
+    hemispheres.add_argument('--pairs', default=None,
+                             help="file with one 'left right' pair per line")
+    hemispheres.set_defaults(run=run_hemispheres)
+
+    reconstruct = subparsers.add_parser(
+        'reconstruct', parents=[common],
+        help="training set patches and their reconstructions")
+    reconstruct.add_argument('models', nargs='+')
+    reconstruct.add_argument('--idx', type=int, nargs='+', default=[4],
+                             help="indices of the patches")
+    reconstruct.set_defaults(run=run_reconstruct)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, 'run', None) is None:
+        build_parser().print_help()
+        return 2
+
+    args.formats = args.formats.split(',')
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    if args.plots:
+        import matplotlib
+        matplotlib.use('Agg')
+    if args.trace:
+        from . import trace
+        trace.enable(args.trace)
+    if args.precision:
+        from .precision import set_precision
+        set_precision(args.precision)
+
+    options = dict(engine=args.engine,
+                   cache_dir=False if args.no_cache else args.cache_dir)
+    if args.batch_size:
+        options['batch_size'] = args.batch_size
+    args.run(args, options)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,57 +1,102 @@
-import os
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+import numpy as np
 
-from pylearn2.utils import serial
+from .reconstruction import (DEFAULT_BATCH_SIZE, analysis_cache_dir,
+                             load_reconstruction)
 
-from .datasets import VanHateren
+# matplotlib and pylearn2 are only imported when needed, so that
+# numeric-only runs start fast.
 
 
-def compare_reconstruction(model_path='sparserf.pkl', img_file_path=None,
-                           img_idx=None, plt_out=None):
+def reconstruct_patches(model_path='sparserf.pkl', img_idx=None,
+                        train_path=None, batch_size=DEFAULT_BATCH_SIZE,
+                        cache_dir=None, engine=None):
+    """
+    Returns the human-viewable (denormalized) training set patches, and
+    their reconstructions, as two [n x 32 x 32] arrays.
+
+    img_idx: index, or list of indices, of the patches (default: 4).
+    cache_dir: where reconstructions of the whole training set are cached;
+        None for the default location, False to only reconstruct the
+        requested patches.
+    engine: 'numpy' reconstructs without Theano; it is the default for
+        models exported by de.inference (.npz).
+    """
+    from .fft_analyze import loadTrainSet
     patch_size = (32, 32)
 
-    print("Loading the training set...")
-    train_path = os.path.join(VanHateren.DATA_DIR, 'train.pkl')
-    train_set = serial.load(train_path)
+    train_path, train_set = loadTrainSet(train_path)
 
-    # Grab an image patch
+    # Grab image patches
     if img_idx is None:
         img_idx = 4
+    img_indices = np.atleast_1d(img_idx)
 
-    print("Grabbing an image patch from the training set...")
-    img_vector = train_set.denormalize_image(train_set.X[img_idx, :])
-    img_patch = img_vector.reshape(patch_size)
-
-    # Show the patch
-    fh = plt.figure()
-    fh.add_subplot(1, 2, 1)
-    plt.imshow(img_patch, cmap=cm.Greys_r)
-    plt.axis('off')
-    plt.title('Original image')
+    print("Grabbing image patches from the training set...")
+    img_vectors = np.asarray(train_set.X[img_indices, :])
 
-    # Run the model and visualize
+    # Run the model
     print("Running the model...")
-    model = serial.load(model_path)
-    [tensor_var] = model.reconstruct([img_vector])
+    cache_dir = analysis_cache_dir(cache_dir)
+    if cache_dir is None:
+        reconstructed_vectors = np.asarray(load_reconstruction(
+            model_path, train_path, img_vectors, batch_size=batch_size,
+            engine=engine))
+    else:
+        reconstructed_vectors = np.asarray(load_reconstruction(
+            model_path, train_path, train_set.X, batch_size=batch_size,
+            cache_dir=cache_dir, engine=engine)[img_indices, :])
+
+    shape = (-1,) + patch_size
+    return (train_set.denormalize_image(img_vectors).reshape(shape),
+            train_set.denormalize_image(reconstructed_vectors).reshape(shape))
+
 
-    # Show the reconstructed patch
+def compare_reconstruction(model_path='sparserf.pkl', img_file_path=None,
+                           img_idx=None, plt_out=None,
+                           batch_size=DEFAULT_BATCH_SIZE,
+                           cache_dir=None, engine=None):
+    """
+    Plots training set patches next to their reconstructions; saved to
+    plt_out if given, else shown.
+
+    See reconstruct_patches for the other arguments.
+    """
+    img_patches, reconstructed_patches = reconstruct_patches(
+        model_path, img_idx=img_idx, batch_size=batch_size,
+        cache_dir=cache_dir, engine=engine)
+    plot_reconstructions(img_patches, reconstructed_patches, plt_out=plt_out)
+
+
+def plot_reconstructions(img_patches, reconstructed_patches, plt_out=None):
+    """
+    Plots each patch next to its reconstruction; saved to plt_out if
+    given, else shown.
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+
+    # Show each patch (left) next to its reconstruction (right)
     print("Plotting...")
-    fh.add_subplot(1, 2, 2)
+    nimages = len(img_patches)
+    fh = plt.figure()
+    for ii in range(nimages):
+        fh.add_subplot(nimages, 2, 2 * ii + 1)
+        plt.imshow(img_patches[ii], cmap=cm.Greys_r)
+        plt.axis('off')
+        plt.title('Original image')
 
-    reconstructed_vector = tensor_var.eval()
-    reconstructed_patch = train_set.denormalize_image(reconstructed_vector)
-    reconstructed_patch = reconstructed_patch.reshape(patch_size)
-    plt.imshow(reconstructed_patch, cmap=cm.Greys_r)
-    plt.axis('off')
-    plt.title('Reconstructed image')
+        fh.add_subplot(nimages, 2, 2 * ii + 2)
+        plt.imshow(reconstructed_patches[ii], cmap=cm.Greys_r)
+        plt.axis('off')
+        plt.title('Reconstructed image')
 
     # Display both to screen
     if plt_out is None:
         plt.show()
     else:
         plt.savefig(plt_out)
-        os.system('eog "%s.png" &' % plt_out)
+        plt.close(fh)
+        print("Saved %s" % plt_out)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+"""
+Sampling of sparse, Gaussian-local connections between hidden units
+and image pixels.
+
+Connections are represented as an index array of shape
+(numHiddenUnits, numCons), holding for every hidden unit the flat
+pixel indices it connects to.  ``connection_mask`` expands that into
+the dense (numPixels x numHiddenUnits) 0/1 matrix used elsewhere.
+
+Seeded connections can be kept in a DiskCache (see cached_connections),
+in the smallest unsigned integer type that holds a pixel index, so
+models built with the same settings and seed skip the sampling.
+"""
+import numpy as np
+from scipy import special
+
+from .cache import fingerprint
+
+# Upper bound on the number of (unit, pixel) scores held in memory at once.
+MAX_CHUNK_ELEMENTS = 2 ** 22
+# Only the pixels within this many standard deviations of a unit (along
+# each axis) are candidates; the probability beyond is below 1e-8.
+WINDOW_SDS = 6
+
+# Bump whenever sample_connections changes what a seed draws.
+SAMPLER_VERSION = 2
+# Size bound of a connection cache; an entry is a few tens of kilobytes.
+CACHE_MAX_BYTES = 2 ** 28
+
+
+def _interval_probs(centers, sd, pixels):
+    """
+    Probability that round(N(center, sd^2)) == pixel, for each center
+    and each of the pixels in its row of pixels, [len(centers) x n].
+    """
+    centers = np.asarray(centers, dtype=float)[:, np.newaxis]
+    pixels = np.asarray(pixels, dtype=float)
+    z_lo = (pixels - 0.5 - centers) / sd
+    z_hi = (pixels + 0.5 - centers) / sd
+
+    # Use the upper tail above the center, to keep precision far from it.
+    upper = z_lo > 0
+    return np.where(upper,
+                    special.ndtr(-z_lo) - special.ndtr(-z_hi),
+                    special.ndtr(z_hi) - special.ndtr(z_lo))
+
+
+def _candidate_axis(centers, halfwidth, size):
+    """
+    The coordinates along one axis of the candidate pixels of each unit,
+    [len(centers) x n]: those within halfwidth of its (rounded, clipped)
+    center, or all of them if the window spans the image.
+    """
+    if 2 * halfwidth + 1 >= size:
+        return np.tile(np.arange(size), (len(centers), 1))
+    centers = np.clip(np.round(centers).astype(int), 0, size - 1)
+    return centers[:, np.newaxis] + np.arange(-halfwidth, halfwidth + 1)
+
+
+def _log_weights(locs, xs, ys, imageSize, variance):
+    """
+    Unnormalized log-probabilities of each unit's sample landing on each
+    of its candidate pixels, the (ys[u, i], xs[u, j]) in row-major order,
+    shape (len(locs), ny * nx); candidates off the image get -inf.
+
+    The sampling convention of the original rejection sampler is kept:
+    a unit at (loc[0], loc[1]) draws (x, y) ~ N(loc, variance), x is
+    bounded by the image length, y by the image height, and the pixel
+    is y * imgLength + x.
+    """
+    imgHeight, imgLength = imageSize
+    locs = np.asarray(locs, dtype=float)
+
+    with np.errstate(divide='ignore'):
+        if variance[0, 1] == 0 and variance[1, 0] == 0:
+            # Independent axes: exact probabilities of the rounded sample.
+            sd = np.sqrt(np.diag(variance))
+            log_px = np.log(_interval_probs(locs[:, 0], sd[0], xs))
+            log_py = np.log(_interval_probs(locs[:, 1], sd[1], ys))
+            log_w = log_py[:, :, np.newaxis] + log_px[:, np.newaxis, :]
+        else:
+            # Correlated axes: density at the pixel center.
+            precision = np.linalg.inv(variance)
+            dx = (xs - locs[:, 0:1])[:, np.newaxis, :]
+            dy = (ys - locs[:, 1:2])[:, :, np.newaxis]
+            log_w = -0.5 * (precision[0, 0] * dx * dx +
+                            (precision[0, 1] + precision[1, 0]) * dx * dy +
+                            precision[1, 1] * dy * dy)
+
+    outside = (((ys < 0) | (ys >= imgHeight))[:, :, np.newaxis] |
+               ((xs < 0) | (xs >= imgLength))[:, np.newaxis, :])
+    log_w = np.where(outside, -np.inf, log_w)
+    return log_w.reshape(len(locs), -1)
+
+
+def sample_connections(imageSize, hiddenUnitLocs, numCons, sigma, rng=None):
+    """
+    Draw numCons distinct, in-bounds pixel connections for every hidden unit.
+
+    Each unit's connections follow the same distribution as repeatedly
+    drawing a rounded Gaussian sample around the unit and rejecting
+    out-of-bounds and duplicate pixels, but all units are sampled at
+    once, without rejection: sampling without replacement from the
+    discretized, truncated Gaussian is done with the Gumbel top-k trick.
+    Only the pixels within WINDOW_SDS standard deviations of each unit
+    are scored (or enough of them for numCons), so the cost grows with
+    the number of units, not with the number of units times pixels.
+
+    Parameters:
+    ----------
+
+    imageSize: (height, length) of the image
+
+    hiddenUnitLocs: [nhidden x 2] array of hidden unit locations
+
+    numCons: number of connections per hidden unit
+
+    sigma: standard deviation matrix; the covariance is sigma ** 2
+
+    rng: numpy RandomState; defaults to the global numpy random state
+
+    Returns an int array of flat pixel indices, [nhidden x numCons].
+    """
+    rng = np.random if rng is None else rng
+    imageSize = tuple(int(s) for s in imageSize)
+    imgHeight, imgLength = imageSize
+    numPixels = imgHeight * imgLength
+    locs = np.asarray(hiddenUnitLocs, dtype=float).reshape(-1, 2)
+    variance = np.square(np.asarray(sigma, dtype=float))
+
+    assert variance.shape == (2, 2), "sigma must be a 2x2 matrix"
+    assert variance[0, 0] > 0 and variance[1, 1] > 0, \
+        "sigma must have a positive diagonal"
+    if numCons > numPixels:
+        raise ValueError("Cannot make %d distinct connections in %d pixels" % (
+            numCons, numPixels))
+
+    # A window of (2h + 1)^2 >= (h + 1)^2 >= numCons pixels, even clipped
+    # by the image borders
+    sd = np.sqrt(np.diag(variance))
+    min_halfwidth = int(np.ceil(np.sqrt(numCons)))
+    halfwidths = [max(int(np.ceil(WINDOW_SDS * s)), min_halfwidth)
+                  for s in sd]
+    xs = _candidate_axis(locs[:, 0], halfwidths[0], imgLength)
+    ys = _candidate_axis(locs[:, 1], halfwidths[1], imgHeight)
+    pixels = (ys[:, :, np.newaxis] * imgLength +
+              xs[:, np.newaxis, :]).reshape(len(locs), -1)
+
+    connections = np.empty((len(locs), numCons), dtype=np.int32)
+    chunk = max(1, MAX_CHUNK_ELEMENTS // pixels.shape[1])
+    for start in range(0, len(locs), chunk):
+        stop = min(start + chunk, len(locs))
+        log_w = _log_weights(locs[start:stop], xs[start:stop],
+                             ys[start:stop], imageSize, variance)
+
+        reachable = np.isfinite(log_w).sum(axis=1)
+        if np.any(reachable < numCons):
+            raise ValueError(
+                "sigma is too small to make %d distinct connections for "
+                "hidden unit %d" % (numCons, start + np.argmin(reachable)))
+
+        keys = log_w + rng.gumbel(size=log_w.shape)
+        top = np.argpartition(-keys, numCons - 1, axis=1)[:, :numCons]
+        rows = np.arange(start, stop)[:, np.newaxis]
+        connections[start:stop] = pixels[rows, top]
+
+    return connections
+
+
+def connection_mask(connections, numPixels, dtype=float):
+    """
+    Expand an index array of connections, [nhidden x numCons], into
+    the dense [numPixels x nhidden] connection matrix.
+    """
+    connections = np.asarray(connections)
+    mask = np.zeros((numPixels, connections.shape[0]), dtype=dtype)
+    units = np.repeat(np.arange(connections.shape[0]), connections.shape[1])
+    mask[connections.ravel(), units] = 1
+    return mask
+
+
+def connections_key(imageSize, nhid, hpl, numCons, sigma, seed):
+    """Returns the cache key of the connections sampled for a model."""
+    return fingerprint('connections', SAMPLER_VERSION,
+                       [int(n) for n in imageSize], int(nhid), int(hpl),
+                       int(numCons), np.asarray(sigma, dtype=float).tolist(),
+                       int(seed))
+
+
+def cached_connections(cache, key, numPixels, sample):
+    """
+    Returns the connections stored under key in cache (a DiskCache),
+    first storing those returned by sample() on a miss.
+    """
+    compact = np.min_scalar_type(numPixels - 1)
+    connections = cache.get_or_compute(
+        key, lambda: np.asarray(sample()).astype(compact))
+    return np.array(connections, dtype=np.int32)
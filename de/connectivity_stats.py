@@ -0,0 +1,131 @@
+"""
+Monte Carlo statistics of sampled connections.
+
+Many trials of sample_connections are drawn at once (the hidden units
+of every trial are sampled as one batch), and checked on the
+[ntrials x nhidden x numCons] index arrays directly, without building
+dense masks.  Trials are split over a pool of worker processes, each
+drawing from its own seed, and the per-worker results are merged.
+
+Like sample_connections, a unit at (loc[0], loc[1]) is centered on the
+pixel in row loc[1] and column loc[0].
+"""
+import multiprocessing
+
+import numpy as np
+
+from .connectivity import sample_connections
+
+# Trials sampled together in a worker; bounds the index arrays in memory.
+DEFAULT_TRIALS_PER_JOB = 25
+
+
+def distance_edges(imageSize):
+    """Returns unit-width bins covering every pixel-to-unit distance."""
+    return np.arange(int(np.ceil(np.hypot(*imageSize))) + 2, dtype=float)
+
+
+def trial_stats(connections, hiddenUnitLocs, imageSize, edges=None):
+    """
+    Returns the statistics of an [ntrials x nhidden x numCons] array of
+    connections (or a single [nhidden x numCons] one), as a dict of:
+
+    unit_counts: [ntrials x nhidden] distinct, in-bounds connections of
+        each unit (numCons, for a valid trial)
+    connections: [ntrials] total of unit_counts
+    self_ratio: [ntrials] proportion of the units connected to the pixel
+        they are centered on
+    distance_hist: [len(edges) - 1] histogram of the distances between
+        units and their connections, over all trials
+    pixel_coverage: [numPixels] number of units connected to each pixel,
+        summed over trials
+    """
+    imageSize = tuple(int(n) for n in imageSize)
+    numPixels = imageSize[0] * imageSize[1]
+    connections = np.asarray(connections)
+    if connections.ndim == 2:
+        connections = connections[np.newaxis]
+    locs = np.asarray(hiddenUnitLocs).reshape(-1, 2)
+    if edges is None:
+        edges = distance_edges(imageSize)
+
+    # Distinct, in-bounds indices of each unit
+    ordered = np.sort(connections, axis=-1)
+    valid = (ordered >= 0) & (ordered < numPixels)
+    valid[..., 1:] &= np.diff(ordered, axis=-1) != 0
+    unit_counts = valid.sum(axis=-1)
+
+    # Connections to the units' own pixels (none, for units off the image)
+    inside = ((locs[:, 0] >= 0) & (locs[:, 0] < imageSize[1]) &
+              (locs[:, 1] >= 0) & (locs[:, 1] < imageSize[0]))
+    own_pixels = np.where(inside, locs[:, 1] * imageSize[1] + locs[:, 0], -1)
+    self_ratio = (connections == own_pixels[:, np.newaxis]).any(
+        axis=-1).mean(axis=-1)
+
+    rows, cols = np.divmod(connections, imageSize[1])
+    distances = np.hypot(rows - locs[:, 1:2], cols - locs[:, 0:1])
+    distance_hist, _ = np.histogram(distances[valid], bins=edges)
+
+    pixel_coverage = np.bincount(ordered[valid], minlength=numPixels)
+
+    return dict(unit_counts=unit_counts,
+                connections=unit_counts.sum(axis=-1),
+                self_ratio=self_ratio,
+                distance_hist=distance_hist,
+                pixel_coverage=pixel_coverage)
+
+
+def _sample_trial_stats(job):
+    """Samples ntrials sets of connections, and returns their trial_stats."""
+    imageSize, locs, numCons, sigma, ntrials, seed, edges = job
+    connections = sample_connections(
+        imageSize, np.tile(locs, (ntrials, 1)), numCons, sigma,
+        rng=np.random.RandomState(seed))
+    return trial_stats(connections.reshape(ntrials, len(locs), numCons),
+                       locs, imageSize, edges)
+
+
+def merge_stats(results):
+    """Merges the trial_stats of disjoint sets of trials."""
+    merged = {}
+    for key in ['unit_counts', 'connections', 'self_ratio']:
+        merged[key] = np.concatenate([result[key] for result in results])
+    for key in ['distance_hist', 'pixel_coverage']:
+        merged[key] = np.sum([result[key] for result in results], axis=0)
+    return merged
+
+
+def connectivity_stats(imageSize, hiddenUnitLocs, numCons, sigma,
+                       ntrials=100, seed=0, n_jobs=None, edges=None,
+                       trials_per_job=DEFAULT_TRIALS_PER_JOB, pool=None):
+    """
+    Samples ntrials sets of connections (see sample_connections) and
+    returns their trial_stats, along with ntrials and distance_edges.
+
+    Trials are sampled in jobs of trials_per_job, the i-th drawing from
+    seed + i, so results only depend on seed and trials_per_job; jobs
+    run in pool, or a pool of n_jobs processes (default: one per core;
+    1 runs them in this process).
+    """
+    imageSize = tuple(int(n) for n in imageSize)
+    locs = np.asarray(hiddenUnitLocs).reshape(-1, 2)
+    edges = distance_edges(imageSize) if edges is None else edges
+    jobs = [(imageSize, locs, numCons, sigma,
+             min(trials_per_job, ntrials - start), seed + ii, edges)
+            for ii, start in enumerate(range(0, ntrials, trials_per_job))]
+
+    if pool is None and n_jobs == 1:
+        results = [_sample_trial_stats(job) for job in jobs]
+    else:
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(
+                min(n_jobs or multiprocessing.cpu_count(), len(jobs)))
+        try:
+            results = pool.map(_sample_trial_stats, jobs)
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+
+    return dict(merge_stats(results), ntrials=ntrials, distance_edges=edges)
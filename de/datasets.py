@@ -1,36 +1,220 @@
-import array
 import glob
+import multiprocessing
 import os
+import warnings
+from multiprocessing.pool import ThreadPool
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # python 2
+    from inspect import getargspec
 
 import numpy as np
 from pylearn2.datasets import dense_design_matrix
 from pylearn2.utils import serial, string_utils
 
+from . import trace
+from .cache import file_stats, fingerprint, point_alias
+from .design import design_path, save_design
+from .normalization import normalize
+from .precision import resolve_dtype
+from .prefetch import (DEFAULT_BUFFER_SIZE, PrefetchIterator, PrefetchWorkers,
+                       can_prefetch, resolve_prefetch)
+from .sharded import DEFAULT_SHARD_ROWS, ShardedArray
 
-def read_iml(filename, width, height, dtype='uint16'):
-    """Reads an IML file and returns as an ndarray."""
 
-    with open(filename, 'rb') as handle:
-        s = handle.read()
-    arr = array.array('H', s)
-    arr.byteswap()
+def read_iml(filename, width, height, dtype='uint16', window=None):
+    """
+    Reads an IML file and returns as an ndarray.
 
-    if width and height:
-        arr = np.array(arr, dtype=dtype).reshape(height, width)
+    The file is memory-mapped as big-endian uint16, so only the pages
+    holding the requested window, a (row_slice, col_slice) tuple, are read.
+    """
+    shape = (height, width) if width and height else None
+    img = np.memmap(filename, dtype='>u2', mode='r', shape=shape)
+    if window is not None:
+        img = img[window]
+    return np.array(img, dtype=dtype)
 
-    return arr
 
+def center_window(width, height, patch_size=(32, 32)):
+    """Returns the (row_slice, col_slice) of the center patch of an image."""
+    left_margin = (width - patch_size[1]) // 2
+    top_margin = (height - patch_size[0]) // 2
+    return (slice(top_margin, top_margin + patch_size[0]),
+            slice(left_margin, left_margin + patch_size[1]))
 
+
+# Returns the center patch transposed (flattened in F order, reshaped in C
+# order); the design matrices hold patches in C order (see extract_patches).
 def get_patch(img, patch_size=(32, 32), width_slice=None, height_slice=None):
     width = img.shape[1]
     height = img.shape[0]
-    left_margin = (width-patch_size[1])/2
-    top_margin = (height-patch_size[0])/2
-    img_patch = img[top_margin: top_margin+patch_size[0],
-                    left_margin:left_margin+patch_size[1]].flatten(1)
+    img_patch = img[center_window(width, height, patch_size)].flatten('F')
     return img_patch.reshape(patch_size)
 
 
+def patch_offsets(width, height, patch_size=(32, 32), stride=None,
+                  npatches=None, rng=None):
+    """
+    Returns the (rows, cols) top-left offsets of patches in an image.
+
+    With stride (an int or a (row, col) pair), the patches lie on a
+    regular grid; with npatches, that many patches are drawn at random
+    (from the grid, if a stride is also given).  With neither, the
+    single center patch is returned.
+    """
+    if stride is None and npatches is None:
+        window = center_window(width, height, patch_size)
+        return np.array([window[0].start]), np.array([window[1].start])
+
+    rng = np.random if rng is None else rng
+    max_row = height - patch_size[0]
+    max_col = width - patch_size[1]
+    if stride is None:
+        return (rng.randint(0, max_row + 1, size=npatches),
+                rng.randint(0, max_col + 1, size=npatches))
+
+    stride = np.broadcast_to(stride, (2,))
+    rows, cols = np.meshgrid(np.arange(0, max_row + 1, stride[0]),
+                             np.arange(0, max_col + 1, stride[1]),
+                             indexing='ij')
+    rows, cols = rows.ravel(), cols.ravel()
+    if npatches is not None:
+        keep = np.sort(rng.choice(len(rows), size=npatches, replace=False))
+        rows, cols = rows[keep], cols[keep]
+    return rows, cols
+
+
+def extract_patches(img, offsets, patch_size=(32, 32)):
+    """
+    Gathers the patches at the given (rows, cols) offsets, through a
+    strided view of all windows of img, into a
+    [npatches x prod(patch_size)] matrix.
+    """
+    img = np.ascontiguousarray(img)
+    height, width = img.shape
+    windows = np.lib.stride_tricks.as_strided(
+        img,
+        shape=(height - patch_size[0] + 1, width - patch_size[1] + 1) +
+        tuple(patch_size),
+        strides=img.strides * 2,
+        writeable=False)
+    rows, cols = offsets
+    return windows[rows, cols].reshape(len(rows), -1)
+
+
+def get_patches(img, patch_size=(32, 32), stride=None, npatches=None,
+                rng=None):
+    """
+    Returns many patches of img, as a [npatches x prod(patch_size)] matrix.
+
+    See patch_offsets for how stride and npatches select the patches.
+    """
+    offsets = patch_offsets(img.shape[1], img.shape[0], patch_size,
+                            stride=stride, npatches=npatches, rng=rng)
+    return extract_patches(img, offsets, patch_size)
+
+
+def load_patches(image_file, loader, width, height, patch_size, offsets):
+    """
+    Loads the patches at the given offsets of an image, reading only the
+    window that bounds them.
+    """
+    rows, cols = offsets
+    top, left = rows.min(), cols.min()
+    window = (slice(top, rows.max() + patch_size[0]),
+              slice(left, cols.max() + patch_size[1]))
+    img = loader(image_file, width=width, height=height, window=window)
+    return extract_patches(img, (rows - top, cols - left), patch_size)
+
+
+class _PatchWriter(object):
+    """Loads the patches of a (row, load_patches args...) job into X."""
+
+    def __init__(self, X):
+        self.X = X
+
+    def __call__(self, job):
+        row = job[0]
+        patches = load_patches(*job[1:])
+        self.X[row:row + len(patches), :] = patches
+        return row
+
+
+_shared_writer = None
+
+
+def _init_shared_writer(X, shape=None, dtype=None):
+    global _shared_writer
+    if shape is not None:  # X is a multiprocessing.RawArray
+        X = np.frombuffer(X, dtype=dtype).reshape(shape)
+    _shared_writer = _PatchWriter(X)
+
+
+def _write_shared_patch(job):
+    return _shared_writer(job)
+
+
+def count_patches(jobs):
+    """Returns the total number of patches of a list of ingestion jobs."""
+    return int(np.sum([len(job[-1][0]) for job in jobs]))
+
+
+def ingest_patches(jobs, img_size, n_jobs=1, pool='process', X=None,
+                   dtype=np.float64):
+    """
+    Loads the patches of every job into a [npatches x img_size] matrix.
+
+    Each job is a (image_file, loader, width, height, patch_size, offsets)
+    tuple, and its patches fill the next rows, in job order.  With
+    n_jobs > 1, the jobs run in a 'process' or 'thread' pool whose
+    workers write straight into the preallocated (shared) matrix.
+
+    X: a preallocated matrix to write into, e.g. a ShardedArray; by
+        default, one of the given dtype is allocated in memory.
+    """
+    counts = [len(job[-1][0]) for job in jobs]
+    first_rows = np.cumsum([0] + counts[:-1])
+    shape = (count_patches(jobs), int(img_size))
+    jobs = [(row,) + tuple(job) for row, job in zip(first_rows, jobs)]
+    if X is not None:
+        assert X.shape == shape, "X must be of shape %s" % (shape,)
+
+    dtype = np.dtype(dtype)
+    if n_jobs <= 1:
+        X = np.empty(shape, dtype=dtype) if X is None else X
+        workers, write = None, _PatchWriter(X)
+        rows = (write(job) for job in jobs)
+    elif pool == 'process':
+        if X is None:
+            raw = multiprocessing.RawArray(dtype.char, int(np.prod(shape)))
+            X = np.frombuffer(raw, dtype=dtype).reshape(shape)
+            initargs = (raw, shape, dtype)
+        else:
+            initargs = (X,)
+        workers = multiprocessing.Pool(n_jobs,
+                                       initializer=_init_shared_writer,
+                                       initargs=initargs)
+        rows = workers.imap_unordered(_write_shared_patch, jobs)
+    elif pool == 'thread':
+        X = np.empty(shape, dtype=dtype) if X is None else X
+        workers = ThreadPool(n_jobs)
+        rows = workers.imap_unordered(_PatchWriter(X), jobs)
+    else:
+        raise ValueError("pool must be 'process' or 'thread'; got %s" % pool)
+
+    try:
+        for ii, _ in enumerate(rows):
+            if ii > 0 and ii % 10 == 0:
+                print('%d of %d' % (ii + 1, len(jobs)))
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
+    return X
+
+
 class ImageDataset(dense_design_matrix.DenseDesignMatrix):
     """
     """
@@ -38,20 +222,62 @@ class ImageDataset(dense_design_matrix.DenseDesignMatrix):
     ALL_LOADERS = {
         '.iml': read_iml, }
 
+    # Arguments that change how, but not what, the design matrix is built.
+    NON_CONTENT_ARGS = ('img_dir', 'n_jobs', 'pool', 'shard_rows')
+    # Bump whenever the preprocessing (e.g. the normalization) changes.
+    DESIGN_VERSION = 1
+
     @classmethod
     def get_image_files(cls, img_dir, filter_fn=lambda *arg: True):
         images = []
         image_loaders = []
-        for image_filepath in glob.glob(os.path.join(img_dir, '*.*')):
+        image_filepaths = sorted(glob.glob(os.path.join(img_dir, '*.*')))
+        for image_filepath in image_filepaths:
             _, ext = os.path.splitext(image_filepath)
             if ext in list(cls.ALL_LOADERS.keys()) and filter_fn(image_filepath):
                 images.append(image_filepath)
                 image_loaders.append(cls.ALL_LOADERS[ext])
         return images, image_loaders
 
+    @classmethod
+    def get_dataset_key(cls, img_dir, **kwargs):
+        """
+        Returns a key that hashes the input image files (paths, sizes and
+        mtimes) and the construction parameters, defaults included.
+        """
+        spec = getargspec(ImageDataset.__init__)
+        params = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+        params.update(kwargs)
+        for arg in cls.NON_CONTENT_ARGS:
+            params.pop(arg, None)
+        params['dtype'] = resolve_dtype(params['dtype'], np.float64).name
+
+        images, _ = cls.get_image_files(img_dir)
+        return fingerprint(cls.__name__, cls.DESIGN_VERSION, params,
+                           file_stats(images))
+
     def __init__(self, which_set, width, height, axes=('b', 0, 1, 'c'),
                  patch_size=(32, 32), img_dir=None, ntrain=200,
-                 ntest=25, nvalid=25):
+                 ntest=25, nvalid=25, n_jobs=1, pool='process',
+                 patches_per_image=None, stride=None, seed=None,
+                 shard_dir=None, shard_rows=DEFAULT_SHARD_ROWS, dtype=None):
+        """
+        n_jobs: number of workers loading images; pool selects whether
+            they are processes ('process') or threads ('thread').
+
+        patches_per_image, stride: how many patches to take from each
+            image, and on what grid (see patch_offsets).  By default,
+            only the center patch is used.
+
+        seed: seed for the random patch offsets.
+
+        shard_dir: when given, the design matrix is built out of core, as
+            memory-mapped shards of shard_rows rows in this directory.
+
+        dtype: precision of the design matrix (and of the .npy file it
+            is saved to); by default, DE_PRECISION if set, else float64
+            (see de.precision).
+        """
 
         assert which_set in self.ALL_DATASETS, \
             "Set specified is not a valid set. Please use 'train' or " \
@@ -61,6 +287,7 @@ class ImageDataset(dense_design_matrix.DenseDesignMatrix):
         self.img_shape = patch_size
         self.img_size = np.prod(patch_size)
         self.img_dir = img_dir
+        dtype = resolve_dtype(dtype, np.float64)
 
         # Get files
         nimages = ntrain + ntest + nvalid
@@ -80,32 +307,114 @@ class ImageDataset(dense_design_matrix.DenseDesignMatrix):
         elif which_set == 'valid':
             img_indices = ntrain + ntest + np.arange(0, nvalid)
 
-        X = np.empty((len(img_indices), self.img_size))
-
         # Take 250 images, convert to 32x32, store in X
-        for ii, img_idx in enumerate(img_indices):
-            if ii > 0 and ii % 10 == 0:
-                print '%d of %d' % (ii + 1, len(img_indices))
-            image_file = images[img_idx]
-            img = image_loaders[img_idx](image_file, width=width, height=height)
-            img_patch = get_patch(img, patch_size=patch_size)
-            X[ii, :] = img_patch.flatten(1)
+        if seed is None:
+            seed = np.random.randint(2 ** 30)
+        jobs = []
+        for img_idx in img_indices:
+            offsets = patch_offsets(
+                width, height, patch_size,
+                stride=stride,
+                npatches=patches_per_image,
+                rng=np.random.RandomState(seed + img_idx))
+            jobs.append((images[img_idx], image_loaders[img_idx],
+                         width, height, patch_size, offsets))
+
+        with trace.span('dataset.ingest', which_set=which_set,
+                        n_jobs=n_jobs, pool=pool) as sp:
+            X = None
+            if shard_dir is not None:
+                X = ShardedArray.create(shard_dir, which_set,
+                                        (count_patches(jobs), self.img_size),
+                                        shard_rows=shard_rows, dtype=dtype)
+            X = ingest_patches(jobs, self.img_size, n_jobs=n_jobs, pool=pool,
+                               X=X, dtype=dtype)
+            sp.add_items(len(X))
 
         # Post-processing
-        self.subtracted_mean = X.mean(axis=0)
-        X = X - self.subtracted_mean
-        self.max_val = np.abs(X).max(axis=0)
-        X = X / self.max_val
+        with trace.span('dataset.normalize', which_set=which_set) as sp:
+            sp.add_items(len(X))
+            X = self._normalize(X, shard_dir is not None)
 
         view_converter = dense_design_matrix.DefaultViewConverter(
             patch_size + (1,),
             axes)
 
-        super(VanHateren, self).__init__(
+        super(ImageDataset, self).__init__(
             X=X,
             view_converter=view_converter,
             axes=axes)
 
+    def _normalize(self, X, sharded):
+        """
+        Centers each pixel of X on its mean, and scales it by its
+        maximum absolute value, in place (see de.normalization).  The
+        statistics are gathered in float64, and kept in X's precision.
+        """
+        mean, max_val = normalize(X)
+        self.subtracted_mean = mean.astype(X.dtype)
+        self.max_val = max_val.astype(X.dtype)
+        if sharded:
+            X.flush()
+            X = ShardedArray(X.paths, mode='r')
+        return X
+
+    @property
+    def out_of_core(self):
+        return isinstance(self.X, ShardedArray)
+
+    def set_prefetch(self, buffer_size=DEFAULT_BUFFER_SIZE, n_jobs=1,
+                     pool='thread', transform=None):
+        """
+        Makes iterator prepare the minibatches of training in the
+        background (see de.prefetch.PrefetchWorkers for the arguments);
+        a buffer_size of 0 turns prefetching off.  Corruption is left to
+        the model's corruptor.
+        """
+        self.prefetch = dict(buffer_size=buffer_size, n_jobs=n_jobs,
+                             pool=pool, transform=transform)
+        self._close_prefetch_workers()
+
+    def _close_prefetch_workers(self):
+        workers = self.__dict__.pop('_prefetch_workers', None)
+        if workers is not None:
+            workers.close()
+
+    def iterator(self, *args, **kwargs):
+        """
+        Returns the DenseDesignMatrix iterator, wrapped in a
+        PrefetchIterator if prefetching is enabled (see set_prefetch).
+
+        Only stochastic iterators, i.e. those of training, are wrapped;
+        the sequential ones of the Monitor are not.
+        The workers are kept from one epoch to the next.
+        """
+        iterator = super(ImageDataset, self).iterator(*args, **kwargs)
+        prefetch = resolve_prefetch(getattr(self, 'prefetch', None))
+        if prefetch is None or not getattr(iterator, 'stochastic', False):
+            return iterator
+        if not can_prefetch(iterator):
+            warnings.warn("Not prefetching: this pylearn2 iterator lacks "
+                          "the attributes of de.prefetch.ITERATOR_ATTRIBUTES")
+            return iterator
+
+        prefetch = dict(prefetch)
+        buffer_size = prefetch.pop('buffer_size', DEFAULT_BUFFER_SIZE)
+        workers = getattr(self, '_prefetch_workers', None)
+        if workers is None or not workers.serves(iterator):
+            self._close_prefetch_workers()
+            workers = PrefetchWorkers.for_iterator(iterator, **prefetch)
+            self._prefetch_workers = workers
+        return PrefetchIterator(iterator, buffer_size=buffer_size,
+                                workers=workers)
+
+    def __getstate__(self):
+        # The prefetch workers are not pickled
+        parent = getattr(super(ImageDataset, self), '__getstate__', None)
+        state = dict(parent() if parent is not None else self.__dict__)
+        state.pop('_prefetch_workers', None)
+        return state
+
     def normalize_image(self, image_data):
         return (image_data - self.subtracted_mean) / self.max_val
 
@@ -117,6 +426,7 @@ class ImageDataset(dense_design_matrix.DenseDesignMatrix):
 class VanHateren(ImageDataset):
 
     DATA_DIR = string_utils.preprocess('${PYLEARN2_DATA_PATH}/vanhateren')
+    CACHE_DIR = os.path.join(DATA_DIR, 'cache')
     VH_WIDTH = 1536
     VH_HEIGHT = 1024
 
@@ -128,29 +438,73 @@ class VanHateren(ImageDataset):
 
     @classmethod
     def create_datasets(cls, datasets=None, overwrite=False,
-                        img_dir=DATA_DIR, output_dir=DATA_DIR):
+                        img_dir=DATA_DIR, output_dir=DATA_DIR,
+                        **dataset_kwargs):
         """Creates the requested datasets, and writes them to disk.
+
+        Extra keyword arguments (e.g. n_jobs) are passed to the dataset.
+
+        Each dataset is stored as <name>-<key>.pkl (and .npy), where the
+        key hashes the image files and the construction parameters (see
+        get_dataset_key), so it is rebuilt exactly when one of those
+        changes and several variants can be cached side by side.
+        <name>.pkl is pointed at the variant requested last, and
+        <name>.design.npz at its design file (see de.design).
+
+        Returns a dict of dataset name to pickle path.
         """
         datasets = datasets or cls.ALL_DATASETS
         serial.mkdir(output_dir)
 
+        key = cls.get_dataset_key(img_dir, **dataset_kwargs)
+        if dataset_kwargs.get('shard_dir') is not None:
+            dataset_kwargs = dict(
+                dataset_kwargs,
+                shard_dir=os.path.join(dataset_kwargs['shard_dir'], key))
+
+        dataset_paths = {}
         for dataset_name in list(datasets):
             file_path_fn = lambda ext: os.path.join(
                 output_dir,
-                '%s.%s' % (dataset_name, ext))
+                '%s-%s.%s' % (dataset_name, key, ext))
 
             output_files = dict([(ext, file_path_fn(ext))
                                  for ext in ['pkl', 'npy']])
+            if dataset_kwargs.get('shard_dir') is not None:
+                del output_files['npy']  # the shards hold the design matrix
             files_missing = np.any([not os.path.isfile(f)
                                     for f in output_files.values()])
 
             if overwrite or np.any(files_missing):
                 print("Loading the %s data" % dataset_name)
-                dataset = cls(which_set=dataset_name, img_dir=img_dir)
+                dataset = cls(which_set=dataset_name, img_dir=img_dir,
+                              **dataset_kwargs)
 
                 print("Saving the %s data" % dataset_name)
-                dataset.use_design_loc(output_files['npy'])
-                serial.save(output_files['pkl'], dataset)
+                with trace.span('dataset.save', which_set=dataset_name):
+                    if dataset.out_of_core:
+                        matrix_paths = dataset.X.paths
+                    else:
+                        dataset.use_design_loc(output_files['npy'])
+                        matrix_paths = [output_files['npy']]
+                    save_design(file_path_fn('design.npz'), matrix_paths,
+                                dataset.subtracted_mean, dataset.max_val)
+                    # The pickle is written last, and atomically, so that
+                    # it only exists once the dataset is complete.
+                    tmp_path = file_path_fn('tmp.pkl')
+                    serial.save(tmp_path, dataset)
+                    os.rename(tmp_path, output_files['pkl'])
+            else:
+                print("Using the cached %s data (%s)" % (dataset_name, key))
+
+            point_alias(os.path.join(output_dir, '%s.pkl' % dataset_name),
+                        output_files['pkl'])
+            if os.path.exists(file_path_fn('design.npz')):
+                point_alias(design_path(os.path.join(
+                    output_dir, '%s.pkl' % dataset_name)),
+                    file_path_fn('design.npz'))
+            dataset_paths[dataset_name] = output_files['pkl']
+        return dataset_paths
 
 
 ##class DEDataset(dense_design_matrix.DenseDesignMatrix):
@@ -172,4 +526,4 @@ class VanHateren(ImageDataset):
         super(VanHateren, self).__init__(X=X, Y=Y, **kwargs)
 """
 if __name__ == "__main__":
-    VanHateren.create_datasets(overwrite=True)
+    VanHateren.create_datasets()
@@ -0,0 +1,78 @@
+"""
+Theano-free access to saved datasets.
+
+VanHateren.create_datasets saves, next to each dataset pickle
+(<name>.pkl), a small design file (<name>.design.npz) holding the
+location of its design matrix (a .npy file, or the shards of an
+out-of-core dataset) and its normalization statistics.  load_dataset
+reads those back as a SavedDesign, so analyses get the patches of a
+dataset without unpickling it through pylearn2, which imports Theano.
+"""
+import os
+
+import numpy as np
+
+from .sharded import ShardedArray
+
+
+def design_path(dataset_path):
+    """Returns the path of the design file of a dataset pickle."""
+    return os.path.splitext(dataset_path)[0] + '.design.npz'
+
+
+def save_design(path, matrix_paths, subtracted_mean, max_val):
+    """
+    Saves a design file: the .npy files of the design matrix (paths are
+    stored relative to the design file), and its normalization.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    np.savez(path,
+             paths=np.array([os.path.relpath(os.path.abspath(p), directory)
+                             for p in matrix_paths]),
+             subtracted_mean=subtracted_mean,
+             max_val=max_val)
+
+
+class SavedDesign(object):
+    """
+    The design matrix X of a saved dataset, memory-mapped, along with its
+    (de)normalize_image, as on the ImageDataset.
+    """
+
+    def __init__(self, X, subtracted_mean, max_val):
+        self.X = X
+        self.subtracted_mean = subtracted_mean
+        self.max_val = max_val
+
+    @classmethod
+    def load(cls, path):
+        # Resolve links first, as the stored paths are relative
+        directory = os.path.dirname(os.path.realpath(path))
+        with np.load(path) as design:
+            paths = [os.path.join(directory, str(p))
+                     for p in design['paths']]
+            subtracted_mean = design['subtracted_mean']
+            max_val = design['max_val']
+        if len(paths) == 1:
+            X = np.load(paths[0], mmap_mode='r')
+        else:
+            X = ShardedArray(paths)
+        return cls(X, subtracted_mean, max_val)
+
+    def normalize_image(self, image_data):
+        return (image_data - self.subtracted_mean) / self.max_val
+
+    def denormalize_image(self, image_data):
+        return (image_data * self.max_val) + self.subtracted_mean
+
+
+def load_dataset(dataset_path):
+    """
+    Returns the SavedDesign of a dataset pickle, or the unpickled dataset
+    if it has no design file (e.g. it was saved before they were).
+    """
+    path = design_path(dataset_path)
+    if os.path.exists(path):
+        return SavedDesign.load(path)
+    from pylearn2.utils import serial
+    return serial.load(dataset_path)
@@ -1,184 +1,265 @@
-from scipy import fftpack
-import numpy as np
-import matplotlib.pyplot as plt
 import os
+
+import numpy as np
+
 import radialProfile
+from de import trace
+from de.reconstruction import (DEFAULT_BATCH_SIZE, analysis_cache_dir,
+                               load_reconstruction)
+from de.spectra import DEFAULT_CHUNK_SIZE, average_magnitude_spectrum
 
-from pylearn2.utils import serial
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
 
-from de.datasets import VanHateren
+# matplotlib, pylearn2 and the datasets are only imported by the
+# functions needing them, so that numeric-only runs start fast.
 
 
 def fft2(image):
-    freq = fftpack.fft2(image)
-    shifted = fftpack.fftshift(freq)
+    freq = np.fft.fft2(image)
+    shifted = np.fft.fftshift(freq)
     return np.abs(shifted)
 
 
-def fft2AverageOnImageSet(images):
-    # Requires images to be of the same shape.
-    total_frequency = np.zeros((images[0].shape))
-    for image in images:
-        total_frequency = np.add(total_frequency, fft2(image))
-    return total_frequency / float(len(images))
+def fft2AverageOnImageSet(images, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
+    # Requires images to be of the same shape; images can be an
+    # [n x h x w] stack, or an iterable of images or chunks of them.
+    return average_magnitude_spectrum(images, chunk_size=chunk_size,
+                                      dtype=dtype)
 
 
-# A function that performs an fft analysis of an image and its reconstruction
-# and plots the analyses for purposes of visualization.
-def singleImageAnalysis(model_path):
+def loadTrainSet(train_path=None):
+    """
+    Returns the path and the loaded training set (its design matrix and
+    normalization, without Theano where possible; see de.design); by
+    default, the van Hateren training set.
+    """
+    from de.design import load_dataset
+    if train_path is None:
+        from de.datasets import VanHateren
+        train_path = os.path.join(VanHateren.DATA_DIR, 'train.pkl')
 
     print("Loading the training set...")
-    train_img = os.path.join(VanHateren.DATA_DIR, 'train.pkl')
-    train_set = serial.load(train_img)
-    patch_size = (32, 32)
+    with trace.span('fft.load_dataset'):
+        return train_path, load_dataset(train_path)
 
-    # Run the model and visualize
-    print("Loading the model...")
-    model = serial.load(model_path)
 
-    list_of_images = []
-    list_of_reconstructed = []
+def patchSpectrum(train_set, X, patch_size=(32, 32),
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns the average 2D spectrum of the human-viewable (denormalized)
+    patches of the design matrix X, streamed chunk by chunk.
+    """
+    chunks = (train_set.denormalize_image(
+        np.asarray(X[start:start + chunk_size])).reshape((-1,) + patch_size)
+        for start in range(0, X.shape[0], chunk_size))
+    with trace.span('fft.spectra') as sp:
+        sp.add_items(X.shape[0])
+        return fft2AverageOnImageSet(chunks, chunk_size=chunk_size)
 
-    print("Beginning the fft analysis...")
 
-    for ii in np.arange(train_set.X.shape[0]):
-        img_vector = train_set.X[ii, :]
+def reconstructedSpectrum(model_path, train_path, train_set,
+                          patch_size=(32, 32), batch_size=DEFAULT_BATCH_SIZE,
+                          cache_dir=None, engine=None):
+    """
+    Returns the average 2D spectrum of the model's reconstructions of
+    the training set patches.
+    """
+    with trace.span('fft.reconstruct', model=model_path):
+        reconstructed = load_reconstruction(
+            model_path, train_path, train_set.X, batch_size=batch_size,
+            cache_dir=analysis_cache_dir(cache_dir), engine=engine)
+    return patchSpectrum(train_set, reconstructed, patch_size)
 
-        # Part for reconstructed
-        [tensor_var] = model.reconstruct([img_vector])
-        reconstructed_vector = tensor_var.eval()
 
-        # Save off human-viewable image patches
-        img_patch = train_set.denormalize_image(img_vector)
-        img_patch = img_patch.reshape(patch_size)
-        list_of_images.append(img_patch)
+def singleImageSpectra(model_path, train_path=None, train_set=None,
+                       batch_size=DEFAULT_BATCH_SIZE, cache_dir=None,
+                       engine=None):
+    """
+    Returns the average 2D spectra (frequency2D, reconstructed2D) of the
+    training set patches and of their reconstructions by the model, and
+    their radial profiles (psd1D, reconstructed_psd1D).
+    """
+    if train_set is None:
+        train_path, train_set = loadTrainSet(train_path)
+
+    print("Beginning the fft analysis...")
+    average_frequency = patchSpectrum(train_set, train_set.X)
+    average_reconstructed = reconstructedSpectrum(
+        model_path, train_path, train_set, batch_size=batch_size,
+        cache_dir=cache_dir, engine=engine)
+
+    with trace.span('fft.radial_profile'):
+        psd1D, reconstructed_psd1D = radialProfile.azimuthalAverage(
+            np.array([average_frequency, average_reconstructed]))
+
+    return dict(frequency2D=average_frequency,
+                reconstructed2D=average_reconstructed,
+                psd1D=psd1D,
+                reconstructed_psd1D=reconstructed_psd1D)
 
-        reconstructed_patch = train_set.denormalize_image(reconstructed_vector)
-        reconstructed_patch = reconstructed_patch.reshape(patch_size)
-        list_of_reconstructed.append(reconstructed_patch)
 
-    average_frequency = fft2AverageOnImageSet(list_of_images)
-    average_reconstructed = fft2AverageOnImageSet(list_of_reconstructed)
+def plotSingleImageSpectra(spectra, out_prefix='fft'):
+    """
+    Saves the spectra of singleImageSpectra to <out_prefix>2D.png and
+    <out_prefix>1D.png; returns both paths.
+    """
+    import matplotlib.pyplot as plt
 
     # Show the 2D Power Analysis
     fh = plt.figure()
     fh.add_subplot(1, 2, 1)
-    plt.imshow(np.log(average_frequency))
+    plt.imshow(np.log(spectra['frequency2D']))
     plt.title('Original Images')
 
     fh.add_subplot(1, 2, 2)
-    plt.imshow(np.log(average_reconstructed))
+    plt.imshow(np.log(spectra['reconstructed2D']))
     plt.title('Reconstructed Images')
 
-    plt.savefig('fft2D.png')
-    os.system('eog fft2D.png &')
-
-    psd1D = radialProfile.azimuthalAverage(average_frequency)
-    reconstructed_psd1D = radialProfile.azimuthalAverage(average_reconstructed)
+    plt.savefig(out_prefix + '2D.png')
+    plt.close(fh)
 
     fg = plt.figure()
     fg.add_subplot(1, 2, 1)
-    plt.plot(np.log(psd1D))
+    plt.plot(np.log(spectra['psd1D']))
     plt.title('Original Images')
 
     fg.add_subplot(1, 2, 2)
-    plt.plot(np.log(reconstructed_psd1D))
+    plt.plot(np.log(spectra['reconstructed_psd1D']))
     plt.title('Reconstructed Images')
 
-    plt.savefig('fft1D.png')
-    os.system('eog fft1D.png &')
+    plt.savefig(out_prefix + '1D.png')
+    plt.close(fg)
+    return out_prefix + '2D.png', out_prefix + '1D.png'
 
 
-# A function that helps visualize the differences between each
-# hemispherical representation of a set of images.
-def hemisphericalDifferences(left_model_path, right_model_path, plotting=None):
-    """
+# A function that performs an fft analysis of an image and its reconstruction
+# and plots the analyses for purposes of visualization.
+@trace.traced('fft.singleImageAnalysis')
+def singleImageAnalysis(model_path, batch_size=DEFAULT_BATCH_SIZE,
+                        cache_dir=None, engine=None, out_prefix='fft'):
     """
-    print("Loading the training set...")
-    train_img = os.path.join(VanHateren.DATA_DIR, 'train.pkl')
-    train_set = serial.load(train_img)
-    patch_size = (32, 32)
-
-    # Load both models
-    print("Loading the models...")
-    left_model = serial.load(left_model_path)
-    right_model = serial.load(right_model_path)
-
-    # Create empty arrays to hold images
-    image_patches = {
-        'orig': [],
-        left_model: [],
-        right_model: [], }
-
-    print("Beginning the fft analysis...")
+    Saves the plots of singleImageSpectra (see plotSingleImageSpectra),
+    and returns the spectra.
 
-    # Go through all the images and add them to the lists
-    for ii in np.arange(train_set.X.shape[0]):
-        img_vector = train_set.X[ii, :]
-        for model in [left_model, right_model]:
+    cache_dir: where reconstructions are cached; None for the default
+        location, False for no caching.
+    """
+    spectra = singleImageSpectra(model_path, batch_size=batch_size,
+                                 cache_dir=cache_dir, engine=engine)
+    for path in plotSingleImageSpectra(spectra, out_prefix):
+        print("Saved %s" % path)
+    return spectra
 
-            # Part for reconstructed
-            [tensor_var] = model.reconstruct([img_vector])
-            reconstructed_vector = tensor_var.eval()
 
-            reconstructed_patch = train_set.denormalize_image(reconstructed_vector)
-            reconstructed_patch = reconstructed_patch.reshape(patch_size)
-            image_patches[model].append(reconstructed_patch)
+def hemisphericalSpectra(left_model_path, right_model_path, train_path=None,
+                         train_set=None, orig_spectrum=None,
+                         batch_size=DEFAULT_BATCH_SIZE, cache_dir=None,
+                         engine=None):
+    """
+    Returns the radial profiles of the average spectra of the training
+    set patches (psd1D), and of their reconstructions by the left and
+    right models (left_psd1D, right_psd1D), along with
+    total_difference = |left - orig| - |right - orig| (RH better: > 0).
 
-        # Save off results
-        img_patch = train_set.denormalize_image(img_vector)
-        img_patch = img_patch.reshape(patch_size)
-        image_patches['orig'].append(img_patch)
+    train_set and orig_spectrum (the average 2D spectrum of its patches)
+    can be passed in to share them between several model pairs.
+    """
+    if train_set is None:
+        train_path, train_set = loadTrainSet(train_path)
 
+    print("Beginning the fft analysis...")
 
-    # Run 2D Analysis
-    average_frequency = fft2AverageOnImageSet(image_patches['orig'])
-    average_left_reconstructed = fft2AverageOnImageSet(
-        image_patches[left_model])
-    average_right_reconstructed = fft2AverageOnImageSet(
-        image_patches[right_model])
+    # Run 2D Analysis, reconstructing all the images with both models
+    if orig_spectrum is None:
+        orig_spectrum = patchSpectrum(train_set, train_set.X)
+    average_reconstructed = [
+        reconstructedSpectrum(model_path, train_path, train_set,
+                              batch_size=batch_size, cache_dir=cache_dir,
+                              engine=engine)
+        for model_path in [left_model_path, right_model_path]]
 
     # Run 1D Analysis
-    psd1D = radialProfile.azimuthalAverage(average_frequency)
-    reconstructed_left_psd1D = radialProfile.azimuthalAverage(
-        average_left_reconstructed)
-    reconstructed_right_psd1D = radialProfile.azimuthalAverage(
-        average_right_reconstructed)
-
+    with trace.span('fft.radial_profile'):
+        [psd1D,
+         reconstructed_left_psd1D,
+         reconstructed_right_psd1D] = radialProfile.azimuthalAverage(
+            np.array([orig_spectrum] + average_reconstructed))
 
     # Get difference of differences
     left_difference = abs(reconstructed_left_psd1D - psd1D)
     right_difference = abs(reconstructed_right_psd1D - psd1D)
     total_difference = left_difference - right_difference   # RH better: > 0
 
+    return dict(psd1D=psd1D,
+                left_psd1D=reconstructed_left_psd1D,
+                right_psd1D=reconstructed_right_psd1D,
+                total_difference=total_difference)
+
+
+def plotHemisphericalSpectra(spectra, left_model_path, right_model_path,
+                             plotting=True):
+    """
+    Plots the spectra of hemisphericalSpectra: saved to plotting if it
+    is a path, else shown.
+    """
+    import matplotlib.pyplot as plt
+    from de.inference import load_model
+
+    left_model = load_model(left_model_path)
+    right_model = load_model(right_model_path)
+    total_difference = spectra['total_difference']
+
     # Plot 3 1D images: The Original, the reconstructions from LH and RH
+    fig = plt.figure(figsize=(12, 6))
+    fig.add_subplot(1, 2, 1)
+    plt.plot(np.asarray([np.log(spectra['psd1D']),
+                         np.log(spectra['left_psd1D']),
+                         np.log(spectra['right_psd1D']), ]).T)
+    plt.legend(['Original',
+                r'LH (\sigma=%.2f)' % np.asarray(left_model.sigma).max(),
+                r'RH (\sigma=%.2f)' % np.asarray(right_model.sigma).max()])
+    plt.xlabel('Spatial frequency')
+    plt.ylabel('Power (log(amplitude))')
+
+    fig.add_subplot(1, 2, 2)
+    plt.plot(total_difference)
+    plt.axhline(0, color='k')  # show X-axis
+    plt.title('Closeness in power differences (RH - LH)')
+    plt.xlabel('Spatial frequency')
+    plt.ylabel('Power difference')
+
+    if isinstance(plotting, string_types):
+        plt.savefig(plotting)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+# A function that helps visualize the differences between each
+# hemispherical representation of a set of images.
+@trace.traced('fft.hemisphericalDifferences')
+def hemisphericalDifferences(left_model_path, right_model_path, plotting=None,
+                             batch_size=DEFAULT_BATCH_SIZE,
+                             cache_dir=None, engine=None):
+    """
+    Returns the total_difference of hemisphericalSpectra, plotting the
+    spectra if plotting is set (see plotHemisphericalSpectra).
+
+    cache_dir: where reconstructions are cached; None for the default
+        location, False for no caching.
+    engine: 'numpy' reconstructs without Theano; it is the default for
+        models exported by de.inference (.npz).
+    """
+    spectra = hemisphericalSpectra(left_model_path, right_model_path,
+                                   batch_size=batch_size,
+                                   cache_dir=cache_dir, engine=engine)
     if plotting:
-        fig = plt.figure(figsize=(12, 6))
-        fig.add_subplot(1, 2, 1)
-        plt.plot(np.asarray([np.log(psd1D),
-                             np.log(reconstructed_left_psd1D),
-                             np.log(reconstructed_right_psd1D), ]).T)
-        plt.legend(['Original',
-                    'LH (\sigma=%.2f)' % np.asarray(left_model.sigma).max(),
-                    'RH (\sigma=%.2f)' % np.asarray(right_model.sigma).max()])
-        plt.xlabel('Spatial frequency')
-        plt.ylabel('Power (log(amplitude))')
-
-        fig.add_subplot(1, 2, 2)
-        plt.plot(total_difference)
-        plt.hold(True)
-        plt.plot(np.ndarray(len(total_difference)),
-                 np.zeros(total_difference.shape))  # show X-axis
-        plt.title('Closeness in power differences (RH - LH)')
-        plt.xlabel('Spatial frequency')
-        plt.ylabel('Power difference')
-
-        if isinstance(plotting, basestring):
-            plt.savefig(plotting)
-        else:
-            plt.show()
-
-    return total_difference
+        plotHemisphericalSpectra(spectra, left_model_path, right_model_path,
+                                 plotting=plotting)
+    return spectra['total_difference']
 
 
 if __name__ == '__main__':
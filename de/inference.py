@@ -0,0 +1,196 @@
+"""
+Theano-free inference for trained (SparseRF)Autoencoder models.
+
+export_model saves a trained model's parameters as plain arrays, in an
+.npz file; NumpyAutoencoder loads them and encodes / reconstructs
+design matrices batch by batch with NumPy alone, so short analysis jobs
+neither import Theano for the model nor compile a graph.
+
+Unlike the pylearn2 DenoisingAutoencoder.reconstruct, the inputs are
+not corrupted first: reconstructions are deterministic.
+"""
+import os
+
+import numpy as np
+
+from . import trace
+from .precision import resolve_dtype
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Elementwise activations, by name; None and 'linear' are the identity.
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    'softplus': lambda x: np.logaddexp(0., x),
+    'rectified_linear': lambda x: np.maximum(x, 0.), }
+
+
+# Other names of ACTIVATIONS, e.g. of theano.tensor.nnet.relu
+ALIASES = {
+    'relu': 'rectified_linear',
+    'rectify': 'rectified_linear', }
+
+
+def activation_name(act):
+    """
+    Returns the ACTIVATIONS name of a pylearn2 activation (None, a name,
+    or the Theano function the name was resolved to), matched exactly.
+    """
+    if act is None:
+        return 'linear'
+    if isinstance(act, str):
+        names = [act]
+    else:  # A Python function, or a Theano Elemwise op with a name
+        names = [getattr(act, '__name__', None), getattr(act, 'name', None),
+                 str(act)]
+    for name in names:
+        if name is None:
+            continue
+        name = ALIASES.get(name.lower(), name.lower())
+        if name in ACTIVATIONS:
+            return name
+    raise ValueError("No NumPy version of the activation %s" % (
+        names[0] or act))
+
+
+def model_arrays(model):
+    """
+    Returns the parameters of a trained Autoencoder as a dict of arrays:
+    the encoder weights (and, for a SparseRFAutoencoder, the
+    connections they belong to), the biases, the decoder weights and
+    the activation names.
+    """
+    arrays = dict(
+        weights=model.weights.get_value(),
+        hidbias=model.hidbias.get_value(),
+        visbias=model.visbias.get_value(),
+        act_enc=np.array(activation_name(model.act_enc)),
+        act_dec=np.array(activation_name(model.act_dec)),
+        nvis=np.array(model.nvis),
+        nhid=np.array(model.nhid), )
+    if getattr(model, 'tied_weights', False):
+        arrays['w_prime'] = arrays['weights'].T
+    else:
+        arrays['w_prime'] = model.w_prime.get_value()
+    if hasattr(model, 'connections'):
+        arrays['connections'] = np.asarray(model.connections)
+    if getattr(model, 'sigma', None) is not None:
+        arrays['sigma'] = np.asarray(model.sigma)
+    return arrays
+
+
+def export_model(model, path):
+    """Saves the parameters of a trained Autoencoder (see model_arrays)."""
+    np.savez(path, **model_arrays(model))
+
+
+def export_pickle(model_path, path):
+    """Exports the model pickled at model_path."""
+    from pylearn2.utils import serial
+    export_model(serial.load(model_path), path)
+
+
+class NumpyAutoencoder(object):
+    """
+    Encodes and reconstructs design matrices with the exported
+    parameters of an Autoencoder.
+
+    The sparse encoder weights of a SparseRFAutoencoder are scattered
+    into a dense [nvis x nhid] matrix once, so each batch is encoded
+    with a single matrix product.
+
+    dtype: the precision to compute in (see de.precision); by default,
+        that of the saved parameters.
+    """
+
+    def __init__(self, arrays, batch_size=DEFAULT_BATCH_SIZE, dtype=None):
+        self.batch_size = batch_size
+        self.nvis = int(arrays['nvis'])
+        self.nhid = int(arrays['nhid'])
+        self.dtype = resolve_dtype(dtype) or np.asarray(
+            arrays['w_prime']).dtype
+        self.hidbias = np.asarray(arrays['hidbias'], dtype=self.dtype)
+        self.visbias = np.asarray(arrays['visbias'], dtype=self.dtype)
+        self.w_prime = np.asarray(arrays['w_prime'], dtype=self.dtype)
+        self.act_enc = ACTIVATIONS[str(arrays['act_enc'])]
+        self.act_dec = ACTIVATIONS[str(arrays['act_dec'])]
+        self.sigma = arrays['sigma'] if 'sigma' in arrays else None
+
+        weights = np.asarray(arrays['weights'], dtype=self.dtype)
+        if 'connections' in arrays:
+            connections = np.asarray(arrays['connections'])
+            self.connections = connections
+            self.W = np.zeros((self.nvis, self.nhid), dtype=self.dtype)
+            units = np.repeat(np.arange(self.nhid), connections.shape[1])
+            np.add.at(self.W, (connections.ravel(), units), weights.ravel())
+        else:
+            self.W = weights
+
+    @classmethod
+    def load(cls, path, batch_size=DEFAULT_BATCH_SIZE, dtype=None):
+        """Loads a model saved by export_model."""
+        with np.load(path) as arrays:
+            return cls(dict(arrays.items()), batch_size=batch_size,
+                       dtype=dtype)
+
+    @classmethod
+    def from_model(cls, model, batch_size=DEFAULT_BATCH_SIZE, dtype=None):
+        return cls(model_arrays(model), batch_size=batch_size, dtype=dtype)
+
+    def _encode(self, batch):
+        return self.act_enc(self.hidbias + batch.dot(self.W))
+
+    def _reconstruct(self, batch):
+        return self.act_dec(self.visbias + self._encode(batch).dot(
+            self.w_prime))
+
+    def _run(self, fn, X, ncols, out):
+        if getattr(X, 'ndim', 2) == 1:
+            X = np.asarray(X)[np.newaxis, :]
+        if out is None:
+            out = np.empty((X.shape[0], ncols), dtype=self.dtype)
+        for start in range(0, X.shape[0], self.batch_size):
+            batch = np.asarray(X[start:start + self.batch_size],
+                               dtype=self.dtype)
+            out[start:start + self.batch_size] = fn(batch)
+        return out
+
+    def encode(self, X, out=None):
+        """Returns the [nexamples x nhid] hidden activations of X's rows."""
+        with trace.span('inference.encode') as sp:
+            sp.add_items(len(X))
+            return self._run(self._encode, X, self.nhid, out)
+
+    def reconstruct(self, X, out=None):
+        """
+        Reconstructs every row of X (an [nexamples x nvis] array, or any
+        object supporting row slicing), like ReconstructionEngine.
+
+        Returns an [nexamples x nvis] ndarray, or fills and returns out.
+        """
+        with trace.span('inference.reconstruct') as sp:
+            sp.add_items(len(X))
+            return self._run(self._reconstruct, X, self.nvis, out)
+
+
+def load_model(model_path, dtype=None):
+    """
+    Loads an exported model (.npz) or a model archive (see de.archive)
+    as a NumpyAutoencoder computing in dtype, and any other file as a
+    pickled model.
+    """
+    if model_path.endswith('.npz'):
+        return NumpyAutoencoder.load(model_path, dtype=dtype)
+    if os.path.isdir(model_path):
+        from .archive import ModelArchive
+        return NumpyAutoencoder(ModelArchive(model_path), dtype=dtype)
+    from pylearn2.utils import serial
+    return serial.load(model_path)
+
+
+if __name__ == '__main__':
+    # python -m de.inference model.pkl model.npz
+    import sys
+    export_pickle(sys.argv[1], sys.argv[2])
@@ -0,0 +1,90 @@
+"""
+Streaming per-pixel normalization of design matrices.
+
+The statistics are gathered in one pass over chunks of rows (from an
+in-memory matrix, a ShardedArray, or any iterable of chunks), then
+applied to the rows in place, so a design matrix is never copied and
+need not fit in memory.
+"""
+import numpy as np
+
+DEFAULT_CHUNK_ROWS = 8192
+
+
+def iter_row_chunks(X, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Yields writable views of at most chunk_size consecutive rows of X,
+    an ndarray or a ShardedArray (opened for writing), in row order.
+    """
+    blocks = X.iter_shards() if hasattr(X, 'iter_shards') else [X]
+    for block in blocks:
+        for start in range(0, len(block), chunk_size):
+            yield block[start:start + chunk_size]
+
+
+class RunningStats(object):
+    """
+    Online per-column mean, minimum and maximum of chunks of rows.
+
+    The mean is updated chunk by chunk (mean += (chunk_mean - mean) * n /
+    count), so it does not accumulate a large sum; the maximum absolute
+    deviation from the mean follows from the extremes, as
+    max(max - mean, mean - min).
+    """
+
+    def __init__(self, ncols):
+        self.count = 0
+        self.mean = np.zeros(ncols)
+        self.min = np.full(ncols, np.inf)
+        self.max = np.full(ncols, -np.inf)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        if len(chunk) == 0:
+            return self
+        self.count += len(chunk)
+        self.mean += (chunk.mean(axis=0) - self.mean) * (
+            len(chunk) / float(self.count))
+        np.minimum(self.min, chunk.min(axis=0), out=self.min)
+        np.maximum(self.max, chunk.max(axis=0), out=self.max)
+        return self
+
+    @property
+    def max_abs(self):
+        """The maximum absolute value of each column, once centered."""
+        return np.maximum(self.max - self.mean, self.mean - self.min)
+
+
+def fit_normalization(chunks, ncols=None):
+    """
+    Returns the (mean, max_abs) of the columns of a sequence of chunks of
+    rows, in a single pass.
+    """
+    stats = None
+    for chunk in chunks:
+        if stats is None:
+            stats = RunningStats(ncols or np.shape(chunk)[1])
+        stats.update(chunk)
+    if stats is None or stats.count == 0:
+        raise ValueError("Cannot normalize an empty design matrix")
+    return stats.mean, stats.max_abs
+
+
+def apply_normalization(chunks, mean, max_val):
+    """Centers and scales each (writable) chunk of rows, in place."""
+    for chunk in chunks:
+        chunk -= mean
+        chunk /= max_val
+
+
+def normalize(X, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Centers each column of X on its mean and scales it by its maximum
+    absolute value, in place, chunk by chunk.
+
+    Returns the (mean, max_val) statistics.
+    """
+    mean, max_val = fit_normalization(iter_row_chunks(X, chunk_size),
+                                      ncols=X.shape[1])
+    apply_normalization(iter_row_chunks(X, chunk_size), mean, max_val)
+    return mean, max_val
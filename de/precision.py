@@ -0,0 +1,114 @@
+"""
+The floating point precision of design matrices, masks and analyses.
+
+Datasets, connection masks and the NumPy reconstruction engine take a
+dtype argument; when it is not given, the DE_PRECISION environment
+variable ('float32' or 'float64') sets it for this process and its
+workers.  Otherwise, datasets default to float64, and models run in the
+precision they were trained in.  (Theano models always run in
+theano.config.floatX; set THEANO_FLAGS=floatX=float32 to match.)
+
+float32 halves the memory and bandwidth of every design matrix and
+reconstruction.  Results differ from float64 ones by rounding only:
+check_precision compares the two against TOLERANCES, e.g.
+
+    python -m de.precision model.pkl [train.pkl]
+
+reconstructs a dataset both ways, and fails if they disagree by more.
+"""
+import os
+
+import numpy as np
+
+ENV_VAR = 'DE_PRECISION'
+PRECISIONS = ('float32', 'float64')
+
+# Expected agreement of float32 (or float64) results with float64 ones,
+# relative to the largest magnitude of the float64 result.  float32
+# rounds to ~6e-8 relative; sums over ~1000 pixels grow that ~100-fold.
+TOLERANCES = {
+    'float32': 1e-5,
+    'float64': 1e-12, }
+
+
+def resolve_dtype(dtype=None, default=None):
+    """
+    Returns the np.dtype to use: dtype if given, else DE_PRECISION if
+    set, else default (None meaning: keep the native precision).
+    """
+    if dtype is None:
+        dtype = os.environ.get(ENV_VAR) or default
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype.name not in PRECISIONS:
+        raise ValueError("precision must be one of %s; got %s" % (
+            PRECISIONS, dtype.name))
+    return dtype
+
+
+def set_precision(dtype):
+    """Sets the default precision, in this process and in its children."""
+    os.environ[ENV_VAR] = resolve_dtype(dtype).name
+
+
+def precision_error(reference, result):
+    """
+    Returns the largest absolute difference between result and the
+    (float64) reference, relative to the largest magnitude of reference.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    result = np.asarray(result, dtype=np.float64)
+    scale = np.abs(reference).max() if reference.size else 0.
+    return np.abs(result - reference).max() / (scale or 1.)
+
+
+def check_precision(reference, result, dtype=None):
+    """
+    Raises a ValueError if result, computed in dtype (by default, its
+    own), differs from the float64 reference by more than TOLERANCES.
+
+    Returns the relative error (see precision_error).
+    """
+    name = np.dtype(dtype or np.asarray(result).dtype).name
+    error = precision_error(reference, result)
+    if error > TOLERANCES[name]:
+        raise ValueError("%s results are off by %.3g (tolerance: %.3g)" % (
+            name, error, TOLERANCES[name]))
+    return error
+
+
+def compare_precisions(model_path, train_path=None, nexamples=None):
+    """
+    Reconstructs the (first nexamples of the) training set with the
+    NumPy engine in float64 and in float32, along with the average
+    spectra of the reconstructions, and checks their agreement.
+
+    Returns a dict of the relative error of each.
+    """
+    from .fft_analyze import loadTrainSet, patchSpectrum
+    from .reconstruction import create_engine
+
+    train_path, train_set = loadTrainSet(train_path)
+    X = np.asarray(train_set.X[:nexamples], dtype=np.float64)
+
+    results = {}
+    for name in ['float64', 'float32']:
+        engine = create_engine(model_path, engine='numpy', dtype=name)
+        reconstructed = engine.reconstruct(X.astype(name))
+        results[name] = dict(
+            reconstruction=reconstructed,
+            spectrum=patchSpectrum(train_set, reconstructed))
+
+    errors = {}
+    for key in ['reconstruction', 'spectrum']:
+        errors[key] = check_precision(results['float64'][key],
+                                      results['float32'][key], 'float32')
+    return errors
+
+
+if __name__ == '__main__':
+    import sys
+    for key, error in sorted(compare_precisions(*sys.argv[1:3]).items()):
+        print("%s: float32 relative error %.3g (tolerance %.3g)" % (
+            key, error, TOLERANCES['float32']))
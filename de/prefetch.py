@@ -0,0 +1,219 @@
+"""
+Background prefetching of minibatches.
+
+PrefetchIterator wraps the iterator of a DenseDesignMatrix (a pylearn2
+FiniteDatasetIterator), and prepares its next buffer_size minibatches
+in PrefetchWorkers, a pool of threads or processes, while the trainer
+works on the current one: reading the rows (from memory, or from the
+shards of an out-of-core dataset), and an optional transform of the
+features (e.g. on-the-fly augmentation).  Batches come out in the
+order of the wrapped iterator.
+
+Batches are not corrupted here: the 'features' rows are both the input
+and the reconstruction target of an autoencoder, and the model's own
+corruptor (e.g. a DenoisingAutoencoder's) corrupts only the input.
+
+ImageDataset.iterator returns one for training iterators when
+prefetching is enabled, by ImageDataset.set_prefetch or by setting
+DE_PREFETCH=<buffer_size> in the environment (e.g. for training from a
+pickled dataset), and keeps its workers from one epoch to the next.
+"""
+import collections
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from . import trace
+
+ENV_VAR = 'DE_PREFETCH'
+DEFAULT_BUFFER_SIZE = 4
+
+
+def resolve_prefetch(settings=None):
+    """
+    Returns the PrefetchIterator arguments to use: settings if given,
+    else a buffer size from DE_PREFETCH, else None (no prefetching).
+    """
+    if settings is None and os.environ.get(ENV_VAR):
+        settings = dict(buffer_size=int(os.environ[ENV_VAR]))
+    if not settings or not settings.get('buffer_size', 1):
+        return None
+    return settings
+
+
+# The private attributes of pylearn2's FiniteDatasetIterator that
+# batches are prepared from; iterators without them are not prefetched.
+ITERATOR_ATTRIBUTES = ('_raw_data', '_source', '_convert', '_return_tuple',
+                       '_subset_iterator')
+
+
+def can_prefetch(iterator):
+    """Whether PrefetchIterator can wrap an iterator."""
+    return all(hasattr(iterator, name) for name in ITERATOR_ATTRIBUTES)
+
+
+class BatchPreparer(object):
+    """
+    Reads the rows of a minibatch from each data source, transforming
+    those of the 'features' source.
+    """
+
+    def __init__(self, raw_data, sources, transform=None):
+        self.raw_data = raw_data
+        self.sources = sources
+        self.transform = transform
+
+    def __call__(self, index):
+        batch = []
+        for data, source in zip(self.raw_data, self.sources):
+            rows = np.array(data[index])
+            if source == 'features' and self.transform is not None:
+                rows = self.transform(rows)
+            batch.append(rows)
+        return batch
+
+
+_shared_preparer = None
+
+
+def _init_shared_preparer(preparer):
+    global _shared_preparer
+    _shared_preparer = preparer
+
+
+def _prepare_shared_batch(index):
+    return _shared_preparer(index)
+
+
+class PrefetchWorkers(object):
+    """
+    n_jobs 'thread' or 'process' workers preparing the minibatches of
+    some data sources (see BatchPreparer for transform), for any number
+    of PrefetchIterators in turn.
+
+    Threads suit in-memory and memory-mapped data, as NumPy copies and
+    file reads release the GIL; processes get a copy of the data sources
+    each, once (only the shard paths, for a ShardedArray), and suit
+    CPU-heavy transforms.
+    """
+
+    def __init__(self, raw_data, sources, n_jobs=1, pool='thread',
+                 transform=None):
+        self.raw_data = tuple(raw_data)
+        self.sources = tuple(sources)
+
+        preparer = BatchPreparer(self.raw_data, self.sources,
+                                 transform=transform)
+        if pool == 'thread':
+            self._pool = ThreadPool(n_jobs)
+            self._prepare = preparer
+        elif pool == 'process':
+            self._pool = multiprocessing.Pool(
+                n_jobs, initializer=_init_shared_preparer,
+                initargs=(preparer,))
+            self._prepare = _prepare_shared_batch
+        else:
+            raise ValueError("pool must be 'process' or 'thread'; got %s"
+                             % pool)
+
+    @classmethod
+    def for_iterator(cls, iterator, **kwargs):
+        return cls(iterator._raw_data, iterator._source, **kwargs)
+
+    def serves(self, iterator):
+        """Whether iterator reads the same data sources."""
+        return (self._pool is not None and
+                tuple(iterator._source) == self.sources and
+                len(iterator._raw_data) == len(self.raw_data) and
+                all(data is own for data, own in zip(iterator._raw_data,
+                                                     self.raw_data)))
+
+    def submit(self, index):
+        """Starts preparing a batch; returns its AsyncResult."""
+        return self._pool.apply_async(self._prepare, (index,))
+
+    def close(self):
+        """Stops the workers; batches being prepared are dropped."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+
+
+class PrefetchIterator(object):
+    """
+    Yields the minibatches of a FiniteDatasetIterator, prepared ahead of
+    time by PrefetchWorkers: the given ones, or else workers created
+    from the keyword arguments and stopped with the iterator.
+
+    At most buffer_size batches are prepared or waiting at any time.
+    Other attributes (batch_size, num_batches, num_examples, uneven,
+    stochastic) are those of the wrapped iterator.
+    """
+
+    def __init__(self, iterator, buffer_size=DEFAULT_BUFFER_SIZE,
+                 workers=None, **kwargs):
+        if not can_prefetch(iterator):
+            raise TypeError("%s lacks the FiniteDatasetIterator attributes "
+                            "%s" % (type(iterator).__name__,
+                                    ', '.join(ITERATOR_ATTRIBUTES)))
+        self._iterator = iterator
+        self.buffer_size = max(int(buffer_size), 1)
+
+        self._own_workers = workers is None
+        if workers is None:
+            workers = PrefetchWorkers.for_iterator(iterator, **kwargs)
+        self._workers = workers
+
+        self._pending = collections.deque()
+        self._fill()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._iterator, name)
+
+    def _fill(self):
+        """Queues batches until buffer_size are pending, or none are left."""
+        while len(self._pending) < self.buffer_size:
+            try:
+                index = next(self._iterator._subset_iterator)
+            except StopIteration:
+                break
+            self._pending.append(self._workers.submit(index))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self._pending:
+            self.close()
+            raise StopIteration
+
+        with trace.span('prefetch.wait'):
+            batch = self._pending.popleft().get()
+        self._fill()
+
+        rval = tuple(fn(data) if fn else data
+                     for data, fn in zip(batch, self._iterator._convert))
+        if not self._iterator._return_tuple and len(rval) == 1:
+            rval, = rval
+        return rval
+
+    __next__ = next  # Python 3
+
+    def close(self):
+        """Drops the pending batches, and stops workers of its own."""
+        self._pending.clear()
+        if self._own_workers:
+            self._workers.close()
+
+    def __del__(self):
+        if getattr(self, '_own_workers', False):
+            self.close()
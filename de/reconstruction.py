@@ -0,0 +1,205 @@
+"""
+Batched reconstruction of whole design matrices through a trained model,
+either with its compiled Theano graph, or with NumPy (see de.inference).
+"""
+import os
+
+import numpy as np
+
+from . import trace
+from .cache import ENV_VAR as CACHE_ENV_VAR
+from .cache import DiskCache, fingerprint, resolve_cache_dir
+from .precision import resolve_dtype
+
+DEFAULT_BATCH_SIZE = 1000
+ENGINES = ('theano', 'numpy')
+# Bump whenever what a cached reconstruction holds changes (version 2:
+# the Theano engine no longer corrupts its inputs).
+CACHE_VERSION = 2
+
+
+class ReconstructionEngine(object):
+    """
+    Compiles a model's encode and decode functions once, then runs
+    design matrices through them in minibatches.
+
+    Unlike DenoisingAutoencoder.reconstruct, the inputs are not
+    corrupted first, so reconstructions are deterministic (as those of
+    de.inference.NumpyAutoencoder) and can be cached.
+    """
+
+    def __init__(self, model, batch_size=DEFAULT_BATCH_SIZE):
+        import theano
+
+        self.model = model
+        self.batch_size = batch_size
+
+        with trace.span('reconstruction.compile'):
+            X = model.get_input_space().make_theano_batch()
+            self.dtype = X.dtype
+            self._reconstruct = theano.function(
+                [X], model.decode(model.encode(X)))
+
+    def reconstruct(self, X, out=None):
+        """
+        Reconstructs every row of X (an [nexamples x nvis] array, or any
+        object supporting row slicing, e.g. a ShardedArray).
+
+        Returns an [nexamples x nvis] ndarray, or fills and returns out.
+        """
+        if getattr(X, 'ndim', 2) == 1:
+            X = np.asarray(X)[np.newaxis, :]
+
+        with trace.span('reconstruction.run') as sp:
+            sp.add_items(X.shape[0])
+            batches = []
+            for start in range(0, X.shape[0], self.batch_size):
+                batch = np.asarray(X[start:start + self.batch_size],
+                                   dtype=self.dtype)
+                if out is None:
+                    batches.append(self._reconstruct(batch))
+                else:
+                    out[start:start + self.batch_size] = \
+                        self._reconstruct(batch)
+        if out is not None:
+            return out
+        if not batches:
+            return np.empty((0, X.shape[1]), dtype=self.dtype)
+        return np.concatenate(batches, axis=0)
+
+
+def engine_name(model_path, engine=None):
+    """
+    Returns the engine ('theano' or 'numpy') to run a saved model with:
+    engine if given, else 'numpy' for exported (.npz) models and model
+    archives (directories).
+    """
+    if engine is None:
+        numpy_only = model_path.endswith('.npz') or os.path.isdir(model_path)
+        engine = 'numpy' if numpy_only else 'theano'
+    if engine not in ENGINES:
+        raise ValueError("engine must be one of %s; got %s" % (ENGINES,
+                                                                engine))
+    return engine
+
+
+def create_engine(model_path, batch_size=DEFAULT_BATCH_SIZE, engine=None,
+                  dtype=None):
+    """
+    Returns an object reconstructing design matrices with the model saved
+    at model_path: a NumpyAutoencoder (de.inference) for the 'numpy'
+    engine, else a ReconstructionEngine.
+
+    dtype: the precision of the 'numpy' engine (see de.precision); the
+        'theano' engine computes in theano.config.floatX.
+    """
+    from .inference import NumpyAutoencoder, load_model
+
+    model = load_model(model_path, dtype=dtype)
+    if isinstance(model, NumpyAutoencoder):
+        if engine_name(model_path, engine) != 'numpy':
+            raise ValueError("%s can only run with the numpy engine"
+                             % model_path)
+        model.batch_size = batch_size
+        return model
+    if engine_name(model_path, engine) == 'numpy':
+        return NumpyAutoencoder.from_model(model, batch_size=batch_size,
+                                           dtype=dtype)
+    return ReconstructionEngine(model, batch_size=batch_size)
+
+
+class StreamedReconstruction(object):
+    """
+    The reconstruction of a design matrix X by a model (an engine from
+    create_engine), computed on access: indexing its rows, e.g. a chunk
+    X[start:stop], only runs those rows through the model, so the whole
+    reconstruction never lives in memory.
+    """
+    ndim = 2
+
+    def __init__(self, model, X):
+        self.model = model
+        self.X = X
+        self.shape = (X.shape[0], X.shape[1])
+        self.dtype = np.dtype(model.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        rval = self.model.reconstruct(self.X)
+        return rval if dtype is None else rval.astype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, None)
+        rval = self.model.reconstruct(np.asarray(self.X[rows]))
+        if np.ndim(rows) == 0 and not isinstance(rows, slice):
+            rval = rval[0]
+        if cols is not None:
+            rval = rval[..., cols]
+        return rval
+
+
+def analysis_cache_dir(cache_dir):
+    """
+    Maps the cache_dir argument of the analyses to a directory (see
+    de.cache.resolve_cache_dir): by default, DE_CACHE_DIR if set, else
+    VanHateren.CACHE_DIR; False for no caching.
+    """
+    if cache_dir is None and not os.environ.get(CACHE_ENV_VAR):
+        from .datasets import VanHateren
+        return VanHateren.CACHE_DIR
+    return resolve_cache_dir(cache_dir)
+
+
+def cached_reconstruction(model_path, dataset_path, X, cache,
+                          batch_size=DEFAULT_BATCH_SIZE, engine=None,
+                          dtype=None):
+    """
+    Returns the reconstruction of X, the design matrix of the dataset
+    saved at dataset_path, by the model saved at model_path.
+
+    The result is kept in cache (a DiskCache), keyed by the contents of
+    both files, so the model is only loaded and run when either changed.
+    It is written to the cache batch by batch, and returned memory-mapped.
+    """
+    engine = engine_name(model_path, engine)
+    dtype = resolve_dtype(dtype)
+    parts = ['reconstruction', CACHE_VERSION, engine, cache.digest(model_path),
+             cache.digest(dataset_path)]
+    if dtype is not None and engine == 'numpy':
+        parts.append(dtype.name)
+    key = fingerprint(*parts)
+    with trace.span('reconstruction.cached', key=key) as sp:
+        reconstructed = cache.get(key)
+        sp.set(hit=reconstructed is not None)
+        if reconstructed is None:
+            model = create_engine(model_path, batch_size=batch_size,
+                                  engine=engine, dtype=dtype)
+            out = cache.create(key, X.shape, dtype=model.dtype)
+            reconstructed = cache.commit(key, model.reconstruct(X, out=out))
+    return reconstructed
+
+
+def load_reconstruction(model_path, dataset_path, X, cache_dir=None,
+                        batch_size=DEFAULT_BATCH_SIZE, engine=None,
+                        dtype=None):
+    """
+    Reconstructs X, the design matrix of the dataset saved at
+    dataset_path, with the model saved at model_path: through
+    cached_reconstruction if a cache_dir is given, else as a
+    StreamedReconstruction, computed chunk by chunk as it is read.
+
+    engine: 'theano' or 'numpy' (see engine_name).
+    dtype: the precision of the 'numpy' engine (see de.precision).
+    """
+    if cache_dir is None:
+        return StreamedReconstruction(
+            create_engine(model_path, batch_size=batch_size, engine=engine,
+                          dtype=dtype), X)
+
+    print("Loading the reconstruction of %s..." % model_path)
+    return cached_reconstruction(model_path, dataset_path, X,
+                                 DiskCache(cache_dir),
+                                 batch_size=batch_size, engine=engine,
+                                 dtype=dtype)
@@ -0,0 +1,186 @@
+"""
+Headless rendering of connection layouts and weight mosaics.
+
+plot_connections draws hidden unit locations and their connections with
+one scatter per layer, rather than one artist per point.  Mosaics of
+receptive fields (connections) and weights are tiled with NumPy and
+written straight to PNG by write_png, which needs neither matplotlib
+nor a display:
+
+    python -m de.render model.pkl [out_prefix]
+
+Pixels are indexed in row-major (C) order throughout, as y * width + x:
+the rows of the design matrix (see de.datasets.extract_patches), the
+encoder weights and the connections all follow it, so receptive fields
+are reshaped to (height, width) in C order.
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .connectivity import connection_mask
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _pyplot(out_path=None):
+    """Imports pyplot, on the Agg backend when saving without a display."""
+    import matplotlib
+    if out_path is not None and not os.environ.get('DISPLAY'):
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_connections(connections, hiddenUnitLocs, imageSize, hpl=1,
+                     out_path=None):
+    """
+    Plots the locations of the hidden units, and the pixels each layer
+    of units connects to; saved to out_path if given, else shown.
+
+    connections: [nhidden x numCons] flat pixel indices (or a list of
+        the indices of each unit, if their numbers differ), the units of
+        layer l being the l-th block of nhidden / hpl rows (as built by
+        SparseRFAutoencoder).
+    hiddenUnitLocs: the (x, y) location of each unit of a layer.
+    """
+    plt = _pyplot(out_path)
+    imgHeight, imgLength = int(imageSize[0]), int(imageSize[1])
+    connections = [np.ravel(unit) for unit in connections]
+    nunits = len(connections) // hpl
+    locs = np.asarray(hiddenUnitLocs).reshape(-1, 2)
+
+    fig = plt.figure()
+    for layer in range(hpl):
+        layer_connections = np.concatenate(
+            connections[layer * nunits:(layer + 1) * nunits])
+        rows, cols = np.divmod(layer_connections, imgLength)
+        plt.scatter(cols, rows, marker='x', s=12, linewidths=0.5,
+                    label='layer %d connections' % layer)
+    plt.scatter(locs[:, 0], locs[:, 1], c='r', marker='o', s=16,
+                label='hidden units')
+    plt.axis([-1, imgLength, -1, imgHeight])
+    plt.gca().set_aspect('equal')
+
+    if out_path is None:
+        plt.show()
+    else:
+        plt.savefig(out_path)
+        plt.close(fig)
+
+
+def write_png(path, image):
+    """
+    Writes a 2D (grayscale) or [h x w x 3] (RGB) image to path as an
+    8-bit PNG; float images are clipped to [0, 1].
+    """
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = np.round(np.clip(image, 0., 1.) * 255).astype(np.uint8)
+    height, width = image.shape[:2]
+    color_type = {2: 0, 3: 2}[image.ndim]
+
+    # Each scanline starts with its filter type (0: none)
+    raw = np.zeros((height, 1 + image[0].size), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, -1)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    with open(path, 'wb') as fp:
+        fp.write(PNG_SIGNATURE)
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                            color_type, 0, 0, 0)))
+        fp.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        fp.write(chunk(b'IEND', b''))
+
+
+def tile_images(images, ncols=None, border=1, symmetric=True):
+    """
+    Arranges an [n x h x w] stack of images into one [rows x cols] grid
+    image, in [0, 1], each tile scaled on its own: symmetrically about
+    0 (0 is mid-gray, as for weights) if symmetric, else from 0 to its
+    maximum.
+    """
+    images = np.asarray(images, dtype=float)
+    n, height, width = images.shape
+    ncols = ncols or int(np.ceil(np.sqrt(n)))
+    nrows = int(np.ceil(n / float(ncols)))
+
+    scale = np.abs(images).reshape(n, -1).max(axis=1)
+    scale[scale == 0] = 1.
+    if symmetric:
+        tiles = 0.5 + images / (2 * scale[:, np.newaxis, np.newaxis])
+    else:
+        tiles = images / scale[:, np.newaxis, np.newaxis]
+
+    # Pad the stack to a full grid, and each tile with its top / left
+    # border, then interleave the rows of the tiles.
+    grid = np.ones((nrows * ncols, height + border, width + border))
+    grid[:n, border:, border:] = tiles
+    grid = grid.reshape(nrows, ncols, height + border, width + border)
+    mosaic = grid.transpose(0, 2, 1, 3).reshape(nrows * (height + border),
+                                                ncols * (width + border))
+    return np.pad(mosaic, ((0, border), (0, border)), mode='constant',
+                  constant_values=1.)
+
+
+def model_weights(model):
+    """
+    Returns the dense [nvis x nhid] encoder weights of a model (pylearn2
+    or NumpyAutoencoder), and the (height, width) of its input images.
+    """
+    weights = model.W if hasattr(model, 'W') else model.get_weights()
+    imageSize = getattr(model, 'imageSize', None)
+    if imageSize is None:
+        side = int(np.sqrt(weights.shape[0]))
+        imageSize = (side, weights.shape[0] // side)
+    return np.asarray(weights), tuple(int(n) for n in imageSize)
+
+
+def weight_mosaic(model, max_units=None, border=1):
+    """Returns the mosaic of the encoder weights of each hidden unit."""
+    weights, imageSize = model_weights(model)
+    tiles = weights[:, :max_units].T.reshape((-1,) + imageSize)
+    return tile_images(tiles, border=border)
+
+
+def connection_mosaic(connections, imageSize, max_units=None, border=1):
+    """Returns the mosaic of the receptive field (pixels) of each unit."""
+    imageSize = tuple(int(n) for n in imageSize)
+    mask = connection_mask(np.asarray(connections)[:max_units],
+                           int(np.prod(imageSize)))
+    return tile_images(mask.T.reshape((-1,) + imageSize), border=border,
+                       symmetric=False)
+
+
+def save_mosaics(model_path, out_prefix, max_units=None, border=1):
+    """
+    Saves the weight mosaic of the model saved at model_path to
+    <out_prefix>_weights.png, and for sparse models, the receptive
+    field mosaic to <out_prefix>_fields.png; returns the paths.
+    """
+    from .inference import load_model
+
+    model = load_model(model_path)
+    paths = [out_prefix + '_weights.png']
+    write_png(paths[0], weight_mosaic(model, max_units, border))
+    if hasattr(model, 'connections'):
+        paths.append(out_prefix + '_fields.png')
+        _, imageSize = model_weights(model)
+        write_png(paths[1], connection_mosaic(model.connections, imageSize,
+                                              max_units, border))
+    return paths
+
+
+if __name__ == '__main__':
+    # python -m de.render model.pkl [out_prefix]
+    import sys
+    model_path = sys.argv[1]
+    out_prefix = sys.argv[2] if len(sys.argv) > 2 else \
+        os.path.splitext(os.path.basename(model_path))[0]
+    for path in save_mosaics(model_path, out_prefix):
+        print("Saved %s" % path)
@@ -0,0 +1,144 @@
+"""
+An out-of-core design matrix, stored as fixed-size, memory-mapped .npy
+shards of rows.
+"""
+import os
+
+import numpy as np
+
+DEFAULT_SHARD_ROWS = 8192
+
+
+class ShardedArray(object):
+    """
+    A 2D array whose rows are split over .npy files, memory-mapped on
+    access.  Indexing with ints, slices, integer or boolean arrays (and
+    an optional column index) returns an in-memory ndarray holding just
+    the requested rows, so minibatches can be read without the whole
+    matrix ever living in memory.
+
+    Only the shard paths are pickled; shards are re-mapped on unpickling.
+    """
+    ndim = 2
+
+    def __init__(self, paths, mode='r'):
+        self.paths = list(paths)
+        self.mode = mode
+        self._open()
+
+    @classmethod
+    def create(cls, directory, prefix, shape, shard_rows=DEFAULT_SHARD_ROWS,
+               dtype=float):
+        """
+        Allocates the shards for an (nrows, ncols) array in directory, as
+        prefix-00000.npy, prefix-00001.npy, ..., and opens them for writing.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        nrows, ncols = int(shape[0]), int(shape[1])
+        paths = []
+        for ii, start in enumerate(range(0, max(nrows, 1), shard_rows)):
+            path = os.path.join(directory, '%s-%05d.npy' % (prefix, ii))
+            shard = np.lib.format.open_memmap(
+                path, mode='w+', dtype=dtype,
+                shape=(min(shard_rows, nrows - start), ncols))
+            del shard  # flushes the header and data to disk
+            paths.append(path)
+        return cls(paths, mode='r+')
+
+    def _open(self):
+        self.shards = [np.load(path, mmap_mode=self.mode)
+                       for path in self.paths]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.shape = (int(self.offsets[-1]), self.shards[0].shape[1])
+        self.dtype = self.shards[0].dtype
+
+    def __getstate__(self):
+        return {'paths': self.paths, 'mode': self.mode}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        rval = np.concatenate(self.shards)
+        return rval if dtype is None else rval.astype(dtype)
+
+    def flush(self):
+        for shard in self.shards:
+            if isinstance(shard, np.memmap):
+                shard.flush()
+
+    def _split_key(self, key):
+        if isinstance(key, tuple):
+            return key[0], (slice(None),) + key[1:]
+        return key, None
+
+    def _row_pieces(self, start, stop):
+        """Yields (shard, local_slice, out_slice) over rows [start, stop)."""
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        for ii in range(first, len(self.shards)):
+            lo, hi = self.offsets[ii], self.offsets[ii + 1]
+            if lo >= stop:
+                break
+            a, b = max(start, lo), min(stop, hi)
+            yield self.shards[ii], slice(a - lo, b - lo), slice(a - start,
+                                                                 b - start)
+
+    def _get_rows(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            rows = int(rows) + (len(self) if rows < 0 else 0)
+            ii = np.searchsorted(self.offsets, rows, side='right') - 1
+            return np.array(self.shards[ii][rows - self.offsets[ii]])
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            if step == 1:
+                out = np.empty((max(stop - start, 0), self.shape[1]),
+                               dtype=self.dtype)
+                for shard, local, dest in self._row_pieces(start, stop):
+                    out[dest] = shard[local]
+                return out
+            rows = np.arange(start, stop, step)
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.nonzero(rows)[0]
+        rows = np.where(rows < 0, rows + len(self), rows)
+        which = np.searchsorted(self.offsets, rows, side='right') - 1
+        out = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        for ii in np.unique(which):
+            sel = which == ii
+            out[sel] = self.shards[ii][rows[sel] - self.offsets[ii]]
+        return out
+
+    def __getitem__(self, key):
+        rows, cols = self._split_key(key)
+        out = self._get_rows(rows)
+        if cols is not None:
+            if out.ndim == 1:
+                cols = cols[1:]
+            out = out[cols]
+        return out
+
+    def __setitem__(self, key, value):
+        """Writes a contiguous block of rows (of all columns)."""
+        rows, cols = self._split_key(key)
+        assert cols is None or cols == (slice(None),) * len(cols), \
+            "only whole rows can be written to a ShardedArray"
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1)
+            value = np.asarray(value)[np.newaxis]
+        start, stop, step = rows.indices(len(self))
+        assert step == 1, "only contiguous rows can be written"
+
+        value = np.broadcast_to(value, (stop - start, self.shape[1]))
+        for shard, local, src in self._row_pieces(start, stop):
+            shard[local] = value[src]
+
+    def iter_shards(self):
+        """Yields the memory-mapped shards, in row order."""
+        return iter(self.shards)
@@ -1,17 +1,33 @@
 import functools
+import os
 
 import numpy as np
 
-from pylearn2.models.autoencoder import DenoisingAutoencoder
-from pylearn2.models.model import Model
+from pylearn2.models.autoencoder import Autoencoder, DenoisingAutoencoder
+from pylearn2.utils import sharedX
+
+from . import trace
+from .cache import DiskCache, resolve_cache_dir
+from .connectivity import (CACHE_MAX_BYTES, cached_connections,
+                           connection_mask, connections_key,
+                           sample_connections)
+
+# Hidden unit locations, by (imageSize, nhid, hpl); they only depend on
+# those, so they are computed once per process.
+_layouts = {}
 
 
 class SparseRFAutoencoder(DenoisingAutoencoder):
     """
     A denoising autoencoder with sparse local receptive fields.
+
+    Only the connected encoder weights are stored: self.connections holds
+    the [nhidden x numCons] pixel indices of each hidden unit, and
+    self.weights the matching [nhidden x numCons] weight values.
     """
 
-    def __init__(self, nhid, numCons, sigma, imageSize, hpl=1, **kwargs):
+    def __init__(self, nhid, numCons, sigma, imageSize, hpl=1, seed=None,
+                 cache_dir=None, connections=None, **kwargs):
         """
         Parameters:
         ----------
@@ -24,22 +40,43 @@ class SparseRFAutoencoder(DenoisingAutoencoder):
 
         imageSize = size of an image
 
+        seed: seed for the connections and the initial weights; by
+            default, one is drawn from the global numpy random state
+            (and kept in self.seed, to rebuild them)
+
+        cache_dir: where connections are cached, keyed by imageSize,
+            nhid, hpl, numCons, sigma and seed; by default, DE_CACHE_DIR
+            if set, else they are not cached (see
+            de.cache.resolve_cache_dir); False for no caching
+
+        connections: the [nhidden x numCons] connections to use (e.g.
+            those of a saved model) instead of sampling them
+
         """
-        nvis = np.prod(imageSize)
         assert nhid % hpl == 0, "nhid must be evenly divisible by hpl"
         kwargs['tied_weights'] = False
-        super(SparseRFAutoencoder, self).__init__(nhid=nhid, **kwargs)
+        if seed is None:
+            seed = np.random.randint(2 ** 30)
+        kwargs.setdefault('rng', np.random.RandomState(seed))
+
+        # The connections must exist before the parent class
+        # initializes the weights.
+        self.nhid = nhid
         self.numCons = numCons
         self.sigma = sigma
         self.hpl = hpl
         self.imageSize = np.array(imageSize)
+        self.seed = seed
+        layout = (tuple(int(n) for n in self.imageSize), nhid, hpl)
+        if layout not in _layouts:
+            _layouts[layout] = self._set_hidden_unit_locations()
+        self.hiddenUnitLocs = _layouts[layout].copy()
+        # nhidden x numCons
+        if connections is None:
+            connections = self._create_connections(cache_dir)
+        self.connections = np.array(connections, dtype=np.int32)
 
-        self.hiddenUnitLocs = self._set_hidden_unit_locations()
-        self.mask = np.empty((nvis, nhid))  # ninput x nhidden
-        for ii in range(hpl):
-            cur_idx = np.arange(nhid // hpl) + ii * (nhid // hpl)
-            self.mask[:, cur_idx] = self._create_connection_mask()
-        self.weights.set_value((self.weights * self.mask).eval())
+        super(SparseRFAutoencoder, self).__init__(nhid=nhid, **kwargs)
 
     def __str__(self):
         props_to_print = dict([(prop_name, getattr(self, prop_name))
@@ -85,8 +122,8 @@ class SparseRFAutoencoder(DenoisingAutoencoder):
         Y = Y + (np.sqrt(scalefactor)) / 2 - 0.5
 
         # Turn into rounded column vectors
-        X = np.round(X).astype(int).flatten(1)
-        Y = np.round(Y).astype(int).flatten(1)
+        X = np.round(X).astype(int).flatten('F')
+        Y = np.round(Y).astype(int).flatten('F')
 
         # Create the outputs from the grids
         connection_matrix = np.zeros(self.imageSize, dtype=bool)
@@ -101,57 +138,101 @@ class SparseRFAutoencoder(DenoisingAutoencoder):
 
         return np.asarray(np.nonzero(connection_matrix)).T
 
-    def _create_connection_mask(self):
-        # Define some useful local variables for sake of clarity
-        imgHeight = self.imageSize[0]
-        imgLength = self.imageSize[1]
-        numPixels = imgHeight * imgLength
-        numHiddenUnits = self.hiddenUnitLocs.shape[0]
-
-        # Initialize the Connection Matrix to all zeroes
-        connectionMatrix = np.zeros(shape=(numPixels, numHiddenUnits))
-        currHiddenUnit = 0  # index to keep track of which hidden unit
-
-        # Create a variance parameter by squaring each element in sigma,
-        # used in Gaussian
-        variance = [[elem * elem for elem in inner] for inner in self.sigma]
-
-        # Loop through the Hidden Units to Create Samples
-        for k in self.hiddenUnitLocs:
-
-            i = 0
-            while i < self.numCons:
-
-                # Get random Gaussian sample which returns an array of tuples
-                [[x, y]] = np.random.multivariate_normal(k, variance, 1)
-
-                # Round the sample to nearest integer
-                x = round(x, 0)
-                y = round(y, 0)
-
-                # Check to see if it's out of bounds.
-                if (x >= imgLength) or (y >= imgHeight) or (x < 0) or (y < 0):
-                    continue
-
-                # Calculate which pixel number it is to add to the map.
-                pixelLoc = (y) * imgLength + (x)
-
-                if (connectionMatrix[pixelLoc][currHiddenUnit] == 1):
-                    continue
+    def _create_connections(self, cache_dir=None):
+        """
+        Samples the connections of every hidden unit in every layer at
+        once, or loads them from the cache in cache_dir.
 
-                connectionMatrix[pixelLoc][currHiddenUnit] = 1
-                i += 1
+        Returns the [nhidden x numCons] array of flat pixel indices.
+        """
+        locs = np.tile(self.hiddenUnitLocs, (self.hpl, 1))
+        sample = lambda: sample_connections(
+            imageSize=self.imageSize,
+            hiddenUnitLocs=locs,
+            numCons=self.numCons,
+            sigma=self.sigma,
+            rng=np.random.RandomState(self.seed))
+
+        cache_dir = resolve_cache_dir(cache_dir)
+        with trace.span('autoencoder.connections', numCons=self.numCons,
+                        hpl=self.hpl) as sp:
+            sp.add_items(len(locs))
+            if cache_dir is None:
+                return sample()
+            cache = DiskCache(os.path.join(cache_dir, 'connections'),
+                              max_bytes=CACHE_MAX_BYTES)
+            key = connections_key(self.imageSize, self.nhid, self.hpl,
+                                  self.numCons, self.sigma, self.seed)
+            sp.set(key=key)
+            return cached_connections(cache, key,
+                                      int(np.prod(self.imageSize)), sample)
+
+    def __setstate__(self, state):
+        # Models pickled before only the connected weights were stored
+        # have dense [ninput x nhidden] weights and mask, no connections
+        if 'connections' not in state and 'mask' in state:
+            state = dict(state)
+            mask = np.asarray(state.pop('mask'))
+            connections = [np.nonzero(mask[:, j])[0]
+                           for j in range(mask.shape[1])]
+            assert len(set(len(cons) for cons in connections)) == 1, \
+                'every hidden unit must have the same number of connections'
+            connections = np.array(connections, dtype=np.int32)
+            weights = state['weights']
+            dense = weights.get_value()
+            units = np.arange(len(connections))[:, np.newaxis]
+            weights.set_value(dense[connections, units])
+            state['connections'] = connections
+            state['numCons'] = connections.shape[1]
+            state.setdefault('seed', None)
+
+        parent = getattr(super(SparseRFAutoencoder, self), '__setstate__',
+                         None)
+        if parent is not None:
+            parent(state)
+        else:
+            self.__dict__.update(state)
+
+    @property
+    def mask(self):
+        """
+        The dense [ninput x nhidden] connection matrix, in the precision
+        of the weights.
+        """
+        with trace.span('autoencoder.mask') as sp:
+            sp.add_items(self.nhid)
+            return connection_mask(self.connections,
+                                   int(np.prod(self.imageSize)),
+                                   dtype=self.weights.dtype)
 
-            currHiddenUnit += 1
+    def _initialize_weights(self, nvis, rng=None, irange=None):
+        """
+        Creates the [nhidden x numCons] connected encoder weights.
+        """
+        rng = self.rng if rng is None else rng
+        irange = self.irange if irange is None else irange
+        self.weights = sharedX(
+            (.5 - rng.rand(*self.connections.shape)) * irange,
+            name='W',
+            borrow=True)
+
+    def _hidden_input(self, x):
+        """
+        Gathers each hidden unit's connected inputs, [... x nhidden x numCons],
+        and takes their weighted sum.
+        """
+        inputs = x.take(self.connections, axis=x.ndim - 1)
+        return self.hidbias + (inputs * self.weights).sum(axis=x.ndim)
 
-        return connectionMatrix
+    @functools.wraps(Autoencoder.get_weights)
+    def get_weights(self, borrow=False):
+        values = self.weights.get_value(borrow=borrow)
+        weights = np.zeros((int(np.prod(self.imageSize)), self.nhid),
+                           dtype=values.dtype)
+        units = np.repeat(np.arange(self.nhid), self.numCons)
+        weights[self.connections.ravel(), units] = values.ravel()
+        return weights
 
-    @functools.wraps(Model._modify_updates)
-    def _modify_updates(self, updates):
-        W = self.weights
-        if W in updates:
-            updates[W] = updates[W] * self.mask
-        return super(SparseRFAutoencoder, self)._modify_updates(updates)
 
 if __name__ == "__main__":
 
@@ -164,8 +245,9 @@ if __name__ == "__main__":
     train(config="sparserf.yaml")
 
     # Visualize the weights
-    from pylearn2.scripts.show_weights import show_weights
-    show_weights(model_path="sparserf.pkl", border=True)
+    from .render import save_mosaics
+    for path in save_mosaics("sparserf.pkl", "sparserf"):
+        print("Saved %s" % path)
 
     # Visualize the reconstruction
     from .compare_reconstruct import compare_reconstruction
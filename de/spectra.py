@@ -0,0 +1,123 @@
+"""
+Batched magnitude spectra of image sets.
+"""
+import numpy as np
+
+from .precision import resolve_dtype
+
+DEFAULT_CHUNK_SIZE = 1024
+
+
+def iter_image_chunks(images, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields [n x h x w] chunks of at most chunk_size images from a stacked
+    array, or from any iterable of 2D images and/or 3D chunks.
+    """
+    if getattr(images, 'ndim', None) == 3:
+        for start in range(0, images.shape[0], chunk_size):
+            yield images[start:start + chunk_size]
+        return
+
+    chunk = []
+    for image in images:
+        image = np.asarray(image)
+        if image.ndim == 3:
+            if chunk:
+                yield np.array(chunk)
+                chunk = []
+            yield image
+            continue
+        chunk.append(image)
+        if len(chunk) == chunk_size:
+            yield np.array(chunk)
+            chunk = []
+    if chunk:
+        yield np.array(chunk)
+
+
+def expand_half_spectrum(half, shape):
+    """
+    Expands the magnitudes of a real-input FFT, [... x h x (w // 2 + 1)],
+    into the full [... x h x w] spectrum, using |F[k1, k2]| = |F[-k1, -k2]|.
+    """
+    height, width = shape
+    nhalf = width // 2 + 1
+    full = np.empty(half.shape[:-2] + tuple(shape), dtype=half.dtype)
+    full[..., :nhalf] = half
+    rows = -np.arange(height) % height
+    cols = width - np.arange(nhalf, width)
+    full[..., nhalf:] = half[..., rows, :][..., cols]
+    return full
+
+
+def magnitude_spectra(images):
+    """
+    Returns the fftshifted 2D magnitude spectrum of every image of an
+    [n x h x w] stack.
+    """
+    images = np.asarray(images)
+    half = np.abs(np.fft.rfft2(images))
+    full = expand_half_spectrum(half, images.shape[-2:])
+    return np.fft.fftshift(full, axes=(-2, -1))
+
+
+class SpectrumAccumulator(object):
+    """
+    Accumulates the 2D magnitude spectra of same-shaped images.
+
+    Spectra are computed a chunk at a time along the leading axis with a
+    real-input FFT, and summed in place over the non-redundant half of
+    the spectrum, so peak memory is bounded by the chunk size.
+
+    dtype: the precision of the spectra (see de.precision); by default,
+        DE_PRECISION if set, else float64.
+    """
+
+    def __init__(self, shape, dtype=None):
+        self.shape = tuple(shape)
+        self.dtype = resolve_dtype(dtype, np.float64)
+        # The sum over all images stays in float64, whatever the dtype: in
+        # float32, each chunk would be rounded against an ever larger total.
+        self.total = np.zeros((self.shape[0], self.shape[1] // 2 + 1),
+                              dtype=np.float64)
+        self.count = 0
+
+    def add(self, images):
+        """Adds a single [h x w] image, or an [n x h x w] stack of them."""
+        images = np.asarray(images, dtype=self.dtype)
+        if images.ndim == 2:
+            images = images[np.newaxis]
+        assert images.shape[1:] == self.shape, \
+            "images must be of shape %s" % (self.shape,)
+
+        self.total += np.abs(np.fft.rfft2(images)).sum(axis=0,
+                                                       dtype=np.float64)
+        self.count += images.shape[0]
+
+    def mean(self, shift=True):
+        """
+        Returns the average magnitude spectrum, with the zero frequency
+        shifted to the center (as fftshift does) unless shift is False.
+        """
+        if not self.count:
+            raise ValueError("no images")
+        full = expand_half_spectrum(
+            (self.total / float(self.count)).astype(self.dtype), self.shape)
+        return np.fft.fftshift(full) if shift else full
+
+
+def average_magnitude_spectrum(images, chunk_size=DEFAULT_CHUNK_SIZE,
+                               dtype=None):
+    """
+    Returns the average, fftshifted 2D magnitude spectrum of a set of
+    same-shaped images (see iter_image_chunks for the accepted inputs),
+    in dtype (see SpectrumAccumulator).
+    """
+    accumulator = None
+    for chunk in iter_image_chunks(images, chunk_size):
+        if accumulator is None:
+            accumulator = SpectrumAccumulator(chunk.shape[1:], dtype=dtype)
+        accumulator.add(chunk)
+    if accumulator is None:
+        raise ValueError("no images")
+    return accumulator.mean()
@@ -0,0 +1,268 @@
+"""
+Parallel hyperparameter sweeps over pairs of hemisphere models, with an
+indexed results store.
+
+A sweep configuration holds one value for each model parameter
+(numCons, nhid, hpl, corruption_level, seed) and a (left, right) pair of
+sigmas.  Each configuration trains a left and a right model, and
+records their hemisphericalSpectra.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from . import trace
+from .cache import fingerprint
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'sparserf_template.yaml')
+
+DEFAULT_MODEL_PARAMS = {
+    'numCons': 10,
+    'nhid': 1024,
+    'hpl': 1,
+    'corruption_level': 0.01,
+    'seed': None, }
+
+
+def render_config(template_path=TEMPLATE_PATH, **params):
+    """Fills the training yaml template with the given parameters."""
+    params = dict(DEFAULT_MODEL_PARAMS, **params)
+    for name, value in params.items():
+        if value is None:
+            params[name] = 'null'
+    with open(template_path) as fp:
+        return fp.read() % params
+
+
+def param_grid(**axes):
+    """
+    Returns the list of all configurations (dicts) combining one value
+    of each parameter, e.g.
+    param_grid(sigma=[(left_sigma, right_sigma)], numCons=[5, 10]).
+    """
+    names = sorted(axes)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[axes[name] for name in names])]
+
+
+def hemisphere_params(config):
+    """Splits a configuration into its (left, right) model parameters."""
+    left_sigma, right_sigma = config['sigma']
+    shared = dict(DEFAULT_MODEL_PARAMS)
+    shared.update((k, v) for k, v in config.items() if k != 'sigma')
+    return dict(shared, sigma=left_sigma), dict(shared, sigma=right_sigma)
+
+
+def _params_key(params):
+    # Unset (None) parameters are left out, so that adding a parameter
+    # with a None default keeps the keys of the models already stored.
+    return fingerprint(dict((k, v) for k, v in params.items()
+                            if v is not None))
+
+
+def model_key(params):
+    """The store key of a model, given its parameters."""
+    return _params_key(params)
+
+
+def comparison_key(config):
+    """The store key of the comparison of a configuration."""
+    return _params_key(config)
+
+
+class SweepStore(object):
+    """
+    Sweep results in a directory: trained models in models/<key>.pkl
+    (and as model archives, models/<key>.archive, for fast loading; see
+    de.archive), hemispheric spectra in results/<key>.npz, and a
+    sqlite index of both (sweep.db), keyed by a hash of their parameters.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for subdir in ['models', 'results']:
+            path = os.path.join(directory, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self.db = sqlite3.connect(os.path.join(directory, 'sweep.db'))
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS models ("
+                "key TEXT PRIMARY KEY, params TEXT, path TEXT, finished REAL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS comparisons ("
+                "key TEXT PRIMARY KEY, left_key TEXT, right_key TEXT, "
+                "params TEXT, path TEXT, finished REAL)")
+
+    def model_path(self, key):
+        return os.path.join(self.directory, 'models', '%s.pkl' % key)
+
+    def archive_path(self, key):
+        return os.path.join(self.directory, 'models', '%s.archive' % key)
+
+    def analysis_path(self, key):
+        """
+        The model to analyze: its archive, which the NumPy engine runs
+        without Theano, or the pickle of a model trained without one.
+        """
+        path = self.archive_path(key)
+        return path if os.path.isdir(path) else self.model_path(key)
+
+    def result_path(self, key):
+        return os.path.join(self.directory, 'results', '%s.npz' % key)
+
+    def _finished(self, table):
+        return set(row[0] for row in
+                   self.db.execute("SELECT key FROM %s" % table))
+
+    def finished_models(self):
+        return self._finished('models')
+
+    def finished_comparisons(self):
+        return self._finished('comparisons')
+
+    def add_model(self, key, params):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?)",
+                (key, json.dumps(params, sort_keys=True),
+                 self.model_path(key), time.time()))
+
+    def add_comparison(self, key, left_key, right_key, config):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO comparisons VALUES (?, ?, ?, ?, ?, ?)",
+                (key, left_key, right_key, json.dumps(config, sort_keys=True),
+                 self.result_path(key), time.time()))
+
+    def comparisons(self, keys=None):
+        """
+        Returns every finished comparison (or those of the given keys),
+        as a dict of its key, config, left_path, right_path (see
+        analysis_path) and result_path.
+        """
+        rows = self.db.execute(
+            "SELECT key, params, left_key, right_key, path "
+            "FROM comparisons ORDER BY finished")
+        if keys is not None:
+            keys = set(keys)
+        return [dict(key=key, config=json.loads(params),
+                     left_path=self.analysis_path(left_key),
+                     right_path=self.analysis_path(right_key),
+                     result_path=result_path)
+                for key, params, left_key, right_key, result_path in rows
+                if keys is None or key in keys]
+
+    def load_result(self, key):
+        """Returns the total_difference curve of a comparison."""
+        with np.load(self.result_path(key)) as result:
+            return result['total_difference']
+
+    def load_spectra(self, key):
+        """Returns the hemisphericalSpectra of a comparison, as a dict."""
+        with np.load(self.result_path(key)) as result:
+            return dict(result)
+
+
+def _train_model(job):
+    key, params, save_path, archive_path, template_path = job
+
+    # Train to a partial file, so only complete models are ever found.
+    partial_path = save_path[:-len('.pkl')] + '.partial.pkl'
+    fd, config_fn = tempfile.mkstemp(suffix='.yaml')
+    with os.fdopen(fd, 'w') as config_fp:
+        config_fp.write(render_config(template_path, save_path=partial_path,
+                                      **params))
+    try:
+        from pylearn2.scripts.train import train
+        with trace.span('sweep.train', key=key, **params):
+            train(config=config_fn)
+    finally:
+        os.remove(config_fn)
+    os.rename(partial_path, save_path)
+
+    from pylearn2.utils import serial
+    from .archive import save_archive
+    save_archive(serial.load(save_path), archive_path)
+    return key
+
+
+def _compare_models(job):
+    key, left_path, right_path, result_path = job
+    from .fft_analyze import hemisphericalSpectra
+    with trace.span('sweep.compare', key=key):
+        spectra = hemisphericalSpectra(left_path, right_path)
+    np.savez(result_path, **spectra)
+    return key
+
+
+def train_models(store, models, pool, template_path=TEMPLATE_PATH):
+    """
+    Trains, in a multiprocessing pool, every model of a {key: params}
+    dict that is not in the store yet, and records it there.
+    """
+    done = store.finished_models()
+    jobs = [(key, params, store.model_path(key), store.archive_path(key),
+             template_path)
+            for key, params in sorted(models.items()) if key not in done]
+    print("Training %d of %d models..." % (len(jobs), len(models)))
+    for key in pool.imap_unordered(_train_model, jobs):
+        store.add_model(key, models[key])
+        print("Trained model %s: %s" % (key, models[key]))
+
+
+def run_sweep(configs, store_dir='sweep', n_jobs=None,
+              template_path=TEMPLATE_PATH):
+    """
+    Trains the left and right models of every configuration in a pool of
+    n_jobs processes (default: one per core), then computes each pair's
+    hemisphericalSpectra, recording everything in a SweepStore (see
+    comparison_key for the key of a configuration).
+
+    Models shared between configurations are trained once, and models
+    and comparisons already in the store are skipped, so an interrupted
+    sweep resumes where it stopped.
+
+    Returns the SweepStore.
+    """
+    store = SweepStore(store_dir)
+
+    models = {}
+    comparisons = {}
+    for config in configs:
+        keys = []
+        for params in hemisphere_params(config):
+            keys.append(model_key(params))
+            models[keys[-1]] = params
+        comparisons[comparison_key(config)] = (keys[0], keys[1], config)
+
+    pool = multiprocessing.Pool(n_jobs or multiprocessing.cpu_count(),
+                                maxtasksperchild=1)
+    try:
+        train_models(store, models, pool, template_path)
+
+        done = store.finished_comparisons()
+        jobs = [(key, store.analysis_path(left_key),
+                 store.analysis_path(right_key), store.result_path(key))
+                for key, (left_key, right_key, _) in sorted(
+                    comparisons.items())
+                if key not in done]
+        print("Comparing %d of %d model pairs..." % (
+            len(jobs), len(comparisons)))
+        for key in pool.imap_unordered(_compare_models, jobs):
+            store.add_comparison(key, *comparisons[key])
+            print("Compared models for %s" % comparisons[key][2])
+    finally:
+        pool.close()
+        pool.join()
+
+    return store
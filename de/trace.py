@@ -0,0 +1,207 @@
+"""
+Lightweight timing spans around pipeline stages.
+
+    with trace.span('dataset.ingest', which_set='train') as sp:
+        ...
+        sp.add_items(npatches)
+
+    @trace.traced('fft.analysis')
+    def analysis(...):
+        ...
+
+Each finished span records its wall time, CPU time, item count and
+attributes.  Tracing is off unless enabled, by enable(path) or by
+setting DE_TRACE=path in the environment (which worker processes
+inherit); while off, span() returns a shared no-op span.
+
+Traces ending in .json are written in the Chrome trace event format
+(open them in chrome://tracing or Perfetto); any other path gets one
+JSON object per line.  Records are appended and flushed one by one,
+under a file lock, so several processes can trace into the same file.
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads are kept from interleaving
+    fcntl = None
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:  # Python 2
+    _cpu_time = time.clock
+
+ENV_VAR = 'DE_TRACE'
+_CHROME_END = b'\n]\n'
+
+_writer = None
+_local = threading.local()
+
+
+class _TraceWriter(object):
+    """Appends span records to a JSON lines or Chrome trace file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.chrome = path.endswith('.json')
+        self.lock = threading.Lock()
+        self.fp = open(path, 'ab+')
+
+    def write(self, record):
+        if self.chrome:
+            args = dict(record['attrs'], cpu=record['cpu'],
+                        items=record['items'])
+            if record['error']:
+                args['error'] = record['error']
+            record = dict(name=record['name'], ph='X', pid=record['pid'],
+                          tid=record['tid'], ts=record['start'] * 1e6,
+                          dur=record['wall'] * 1e6, args=args)
+        line = json.dumps(record, sort_keys=True, default=str).encode('utf-8')
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.fp, fcntl.LOCK_EX)
+            try:
+                if self.chrome:
+                    self._append_event(line)
+                else:
+                    self.fp.write(line + b'\n')
+                self.fp.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.fp, fcntl.LOCK_UN)
+
+    def _append_event(self, line):
+        # Keeps the file a complete JSON array, by moving its closing
+        # bracket after each new event.
+        self.fp.seek(0, os.SEEK_END)
+        size = self.fp.tell()
+        self.fp.seek(max(size - len(_CHROME_END), 0))
+        tail = self.fp.read()
+        if size == 0:
+            separator = b'[\n'
+        elif tail == _CHROME_END:
+            self.fp.truncate(size - len(_CHROME_END))
+            separator = b',\n'
+        else:
+            separator = b'' if tail.endswith(b',\n') else b',\n'
+        self.fp.write(separator + line + _CHROME_END)
+
+    def close(self):
+        self.fp.close()
+
+
+def enable(path):
+    """Starts tracing to path, in this process and in its children."""
+    global _writer
+    disable()
+    _writer = _TraceWriter(path)
+    os.environ[ENV_VAR] = path
+
+
+def disable():
+    """Stops tracing."""
+    global _writer
+    if _writer is not None:
+        _writer.close()
+    _writer = None
+    os.environ.pop(ENV_VAR, None)
+
+
+def enabled():
+    return _writer is not None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add_items(self, n):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """A timed stage; use span() to create one."""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.items = None
+
+    def add_items(self, n):
+        """Counts n more items (e.g. images, patches) processed."""
+        self.items = (self.items or 0) + int(n)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.time()
+        self.cpu_start = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.start
+        cpu = _cpu_time() - self.cpu_start
+        _local.stack.pop()
+
+        writer = _writer
+        if writer is not None:
+            writer.write(dict(
+                name=self.name,
+                parent=self.parent,
+                start=self.start,
+                wall=wall,
+                cpu=cpu,
+                items=self.items,
+                attrs=self.attrs,
+                pid=os.getpid(),
+                tid=threading.current_thread().ident,
+                error=None if exc_type is None else exc_type.__name__))
+        return False
+
+
+def span(name, **attrs):
+    """
+    Returns a context manager timing the enclosed stage; extra keyword
+    arguments are recorded as attributes of the span.
+    """
+    if _writer is None:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator timing every call of a function as a span."""
+    def decorator(fn):
+        span_name = name or '%s.%s' % (fn.__module__, fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _writer is None:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
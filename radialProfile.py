@@ -1,42 +1,110 @@
 # Taken from:
 # http://www.astrobetter.com/wiki/tiki-index.php?page=python_image_fft
 
+import collections
+
 import numpy as np
 
-def azimuthalAverage(image, center=None):
+
+class RadialBinPlan(object):
     """
-    Calculate the azimuthally averaged radial profile.
+    Assignment of the pixels of an image shape to radial bins around a
+    center, computed once and applied to any number of images.
 
-    image - The 2D image
+    shape - The (height, width) of the images
     center - The [x,y] pixel coordinates used as the center. The default is
              None, which then uses the center of the image (including
-             fracitonal pixels).
-
+             fractional pixels).
+    binsize - Width of the linear bins; bin i holds radii in
+              [i * binsize, (i + 1) * binsize).  Fractional sizes are fine.
+    log - Use nbins logarithmically spaced bins instead, from the
+          smallest non-zero radius; the first bin also holds the center.
+    nbins - Number of log bins (default: as many as linear bins).
     """
-    # Calculate the indices from the image
-    y, x = np.indices(image.shape)
 
-    if not center:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
+    def __init__(self, shape, center=None, binsize=1, log=False, nbins=None):
+        self.shape = tuple(shape)
+
+        # Calculate the indices from the image
+        y, x = np.indices(self.shape)
+        if center is None:
+            center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
+        r = np.hypot(x - center[0], y - center[1]).ravel()
+        rmax = r.max()
+
+        if not log:
+            nlinear = int(np.floor(rmax / binsize)) + 1
+            self.edges = np.arange(nlinear + 1) * float(binsize)
+        else:
+            nbins = nbins or int(np.floor(rmax / binsize)) + 1
+            rmin = r[r > 0].min() if np.any(r > 0) else 1.
+            self.edges = np.logspace(np.log10(rmin), np.log10(rmax),
+                                     nbins + 1)
+            self.edges[0] = 0.  # no pixel is closer than rmin but the center
+            self.edges[-1] = np.nextafter(rmax, np.inf)  # keep rmax inside
+        self.nbins = len(self.edges) - 1
+
+        # Find the bin of every pixel
+        self.bin_index = np.searchsorted(self.edges, r, side='right') - 1
+        self.bin_index = np.minimum(self.bin_index, self.nbins - 1)
+        self.counts = np.bincount(self.bin_index, minlength=self.nbins)
+        self.radii = (self.edges[:-1] + self.edges[1:]) / 2.
+
+    def apply(self, images):
+        """
+        Returns the mean of each radial bin of an image, or of each image
+        of an [n x h x w] stack; bins without pixels are NaN.
+        """
+        images = np.asarray(images)
+        single_image = images.ndim == 2
+        images = images.reshape((-1,) + self.shape)
+        nimages = images.shape[0]
+
+        # One bincount over (image, bin) groups covers the whole stack
+        groups = (np.arange(nimages)[:, np.newaxis] * self.nbins +
+                  self.bin_index[np.newaxis, :])
+        totals = np.bincount(groups.ravel(),
+                             weights=images.reshape(nimages, -1).ravel(),
+                             minlength=nimages * self.nbins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            radial_prof = totals.reshape(nimages, self.nbins) / self.counts
 
-    r = np.hypot(x - center[0], y - center[1])
-    # Get sorted radii
-    ind = np.argsort(r.flat)
-    r_sorted = r.flat[ind]
-    i_sorted = image.flat[ind]
+        return radial_prof[0] if single_image else radial_prof
 
-    # Get the integer part of the radii (bin size = 1)
-    r_int = r_sorted.astype(int)
 
-    # Find all pixels that fall within each radial bin.
-    deltar = r_int[1:] - r_int[:-1]  # Assumes all radii represented
-    rind = np.where(deltar)[0]       # location of changed radius
-    nr = rind[1:] - rind[:-1]        # number of radius bin
+# The most recently used bin plans; each holds an index per pixel.
+MAX_BIN_PLANS = 8
+_bin_plans = collections.OrderedDict()
 
-    # Cumulative sum to figure out sums for each radius bin
-    csim = np.cumsum(i_sorted, dtype=float)
-    tbin = csim[rind[1:]] - csim[rind[:-1]]
 
-    radial_prof = tbin / nr
+def get_bin_plan(shape, center=None, binsize=1, log=False, nbins=None):
+    """Returns the (cached) RadialBinPlan for these parameters."""
+    key = (tuple(shape), None if center is None else tuple(center),
+           binsize, log, nbins)
+    plan = _bin_plans.pop(key, None)
+    if plan is None:
+        plan = RadialBinPlan(shape, center=center, binsize=binsize,
+                             log=log, nbins=nbins)
+    _bin_plans[key] = plan
+    while len(_bin_plans) > MAX_BIN_PLANS:
+        _bin_plans.popitem(last=False)
+    return plan
 
-    return radial_prof
+
+def azimuthalAverage(image, center=None, binsize=1, log=False, nbins=None):
+    """
+    Calculate the azimuthally averaged radial profile.
+
+    image - The 2D image, or an [n x h x w] stack of images
+    center - The [x,y] pixel coordinates used as the center. The default is
+             None, which then uses the center of the image (including
+             fracitonal pixels).
+    binsize, log, nbins - The radial binning; see RadialBinPlan.
+
+    Returns every radial bin, starting at the center; bin plans are
+    cached per (shape, center, binning).
+    """
+    image = np.asarray(image)
+    plan = get_bin_plan(image.shape[-2:], center=center, binsize=binsize,
+                        log=log, nbins=nbins)
+    return plan.apply(image)
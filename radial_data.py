@@ -1,7 +1,8 @@
 # Taken from:
 # http://www.astrobetter.com/wiki/tiki-index.php?page=python_image_fft
 
-def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
+def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None,
+                dtype=None):
     """
     r = radial_data(data,annulus_width,working_mask,x,y)
 
@@ -11,7 +12,8 @@ def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
     ------
     data   - whatever data you are radially averaging.  Data is
             binned into a series of annuli of width 'annulus_width'
-            pixels.
+            pixels.  A stack of images, [n x h x w], is profiled
+            image by image.
     annulus_width - width of each annulus.  Default is 1.
     working_mask - array of same size as 'data', with zeros at
                       whichever 'data' points you don't want included
@@ -20,6 +22,8 @@ def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
              the center of the data).  By default, these are set to
              integer meshgrids
       rmax -- maximum radial value over which to compute statistics
+      dtype -- precision of the statistics (see de.precision); by
+             default, DE_PRECISION if set, else float64
 
      OUTPUT:
      -------
@@ -32,8 +36,11 @@ def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
           .max    - maximum value in the annulus
           .min    - minimum value in the annulus
           .numel  - number of elements in the annulus
+        For a stack of images, each statistic is [n x nbins].
     """
 
+# Vectorized: each pixel is binned once, statistics are grouped
+#   reductions, and the median comes from one sort by (bin, value).
 # 2010-03-10 19:22 IJC: Ported to python from Matlab
 # 2005/12/19 Added 'working_region' option (IJC)
 # 2005/12/15 Switched order of outputs (IJC)
@@ -41,6 +48,7 @@ def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
 # 2005/11/04 by Ian Crossfield at the Jet Propulsion Laboratory
 
     import numpy as ny
+    from de.precision import resolve_dtype
 
     class radialDat:
         """Empty object container.
@@ -57,61 +65,86 @@ def radial_data(data,annulus_width=1,working_mask=None,x=None,y=None,rmax=None):
     #---------------------
     # Set up input parameters
     #---------------------
-    data = ny.array(data)
-
-    if working_mask==None:
-        working_mask = ny.ones(data.shape,bool)
-
-    npix, npiy = data.shape
-    if x==None or y==None:
+    dtype = resolve_dtype(dtype, ny.float64)
+    data = ny.array(data, dtype=dtype)
+    single_image = data.ndim == 2
+    if single_image:
+        data = data[ny.newaxis]
+    nimages = data.shape[0]
+
+    if working_mask is None:
+        working_mask = ny.ones(data.shape[1:],bool)
+
+    npix, npiy = data.shape[1:]
+    if x is None or y is None:
         x1 = ny.arange(-npix/2.,npix/2.)
         y1 = ny.arange(-npiy/2.,npiy/2.)
         x,y = ny.meshgrid(y1,x1)
 
     r = abs(x+1j*y)
 
-    if rmax==None:
+    if rmax is None:
         rmax = r[working_mask].max()
 
     #---------------------
     # Prepare the data container
     #---------------------
-    dr = ny.abs([x[0,0] - x[0,1]]) * annulus_width
+    dr = ny.abs(x[0,0] - x[0,1]) * annulus_width
     radial = ny.arange(rmax/dr)*dr + dr/2.
     nrad = len(radial)
     radialdata = radialDat()
-    radialdata.mean = ny.zeros(nrad)
-    radialdata.std = ny.zeros(nrad)
-    radialdata.median = ny.zeros(nrad)
-    radialdata.numel = ny.zeros(nrad)
-    radialdata.max = ny.zeros(nrad)
-    radialdata.min = ny.zeros(nrad)
     radialdata.r = radial
 
     #---------------------
-    # Loop through the bins
+    # Assign each pixel to its annulus, [minrad, minrad + dr)
+    #---------------------
+    minrad = ny.arange(nrad)*dr
+    bins = ny.searchsorted(minrad, r.ravel(), side='right') - 1
+    keep = working_mask.ravel().astype(bool) & (bins >= 0)
+    keep[keep] &= r.ravel()[keep] < minrad[bins[keep]] + dr
+    pixels = ny.nonzero(keep)[0]
+
+    # One group per (image, annulus)
+    groups = (ny.arange(nimages)[:,ny.newaxis]*nrad + bins[pixels]).ravel()
+    values = data.reshape(nimages, -1)[:, pixels].ravel()
+    ngroups = nimages*nrad
+
+    #---------------------
+    # Grouped statistics; the sums are accumulated in float64 (bincount's
+    # weights), and only the results are cast to dtype
     #---------------------
-    for irad in range(nrad): #= 1:numel(radial)
-      minrad = irad*dr
-      maxrad = minrad + dr
-      thisindex = (r>=minrad) * (r<maxrad) * working_mask
-      if not thisindex.ravel().any():
-        radialdata.mean[irad] = ny.nan
-        radialdata.std[irad]  = ny.nan
-        radialdata.median[irad] = ny.nan
-        radialdata.numel[irad] = ny.nan
-        radialdata.max[irad] = ny.nan
-        radialdata.min[irad] = ny.nan
-      else:
-        radialdata.mean[irad] = data[thisindex].mean()
-        radialdata.std[irad]  = data[thisindex].std()
-        radialdata.median[irad] = ny.median(data[thisindex])
-        radialdata.numel[irad] = data[thisindex].size
-        radialdata.max[irad] = data[thisindex].max()
-        radialdata.min[irad] = data[thisindex].min()
+    numel = ny.bincount(groups, minlength=ngroups).astype(float)
+    empty = numel == 0
+    numel[empty] = ny.nan
+    mean = ny.bincount(groups, weights=values, minlength=ngroups) / numel
+    sqdev = (values - mean[groups])**2
+    std = ny.sqrt(ny.bincount(groups, weights=sqdev, minlength=ngroups) / numel)
+
+    # Sorting by (group, value) gives the min, max and median of each group
+    order = ny.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = ny.where(empty, 0, numel).astype(int)
+    starts = ny.concatenate(([0], ny.cumsum(counts)[:-1]))
+    last = ny.maximum(starts + counts - 1, 0)
+    lo_mid = ny.maximum(starts + (counts - 1)//2, 0)
+    hi_mid = ny.maximum(starts + counts//2, 0)
+
+    sorted_values = ny.concatenate((sorted_values, [ny.nan]))  # for empty bins
+    minimum = ny.where(empty, ny.nan, sorted_values[ny.where(empty, -1, starts)])
+    maximum = ny.where(empty, ny.nan, sorted_values[ny.where(empty, -1, last)])
+    median = ny.where(empty, ny.nan,
+                      (sorted_values[ny.where(empty, -1, lo_mid)] +
+                       sorted_values[ny.where(empty, -1, hi_mid)]) / 2.)
 
     #---------------------
     # Return with data
     #---------------------
+    shape = (nrad,) if single_image else (nimages, nrad)
+    radialdata.mean = mean.reshape(shape).astype(dtype)
+    radialdata.std = ny.where(empty, ny.nan, std).reshape(shape).astype(dtype)
+    radialdata.median = median.reshape(shape).astype(dtype)
+    radialdata.numel = numel.reshape(shape)
+    radialdata.max = maximum.reshape(shape).astype(dtype)
+    radialdata.min = minimum.reshape(shape).astype(dtype)
 
     return radialdata
@@ -1,30 +1,38 @@
 
+# Set DE_PREFETCH=<n> to prepare n minibatches ahead of the trainer (see
+# de.prefetch).
+# Set DE_TRACE=<path> to record the time spent in each stage (see de.trace).
 if __name__ == "__main__":
     import tempfile
 
+    from de import trace
+
     weights_file = 'sparserf_example.pkl'
-    params = (10, [[3, 0], [0, 3]], weights_file)
+    params = {'numCons': 10, 'sigma': [[3, 0], [0, 3]]}
 
     # Create the dataset
     from de.datasets import VanHateren
-    VanHateren.create_datasets()
+    with trace.span('driver.create_datasets'):
+        VanHateren.create_datasets()
 
     # Create the yaml file.
+    from de.sweep import render_config
     _, config_fn = tempfile.mkstemp()
-    with open("sparserf_template.yaml") as fp:
-        # create yaml from templtes + params
-        config_yaml = "".join(fp.readlines()) % params
+    config_yaml = render_config(save_path=weights_file, **params)
     with open(config_fn, 'w') as config_fp:
         config_fp.write(config_yaml)
 
     # Train the network
     from pylearn2.scripts.train import train
-    train(config=config_fn)
+    with trace.span('driver.train'):
+        train(config=config_fn)
 
     # Visualize the weights
-    from pylearn2.scripts.show_weights import show_weights
-    show_weights(model_path=weights_file, border=True)
+    from de.render import save_mosaics
+    for path in save_mosaics(weights_file, 'sparserf_example'):
+        print("Saved %s" % path)
 
     # Visualize the reconstruction
     from de.compare_reconstruct import compare_reconstruction
-    compare_reconstruction(model_path=weights_file)
+    with trace.span('driver.compare_reconstruction'):
+        compare_reconstruction(model_path=weights_file)